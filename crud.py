@@ -1,4 +1,6 @@
 import time
+from collections.abc import Callable
+from itertools import count
 
 from lnbits.db import Database
 
@@ -21,12 +23,35 @@ from .paranoia import (
     assert_valid_msats,
     assert_valid_positive_int,
     assert_valid_pubkey,
+    assert_valid_sha256,
     assert_valid_timestamp_seconds,
     assert_valid_wallet_id,
 )
 
 db = Database("ext_nwcprovider")
 
+# In-memory mirror of the registered client pubkeys, used to reject requests
+# from unknown clients before decrypting them and querying the database
+registered_pubkeys: set[str] = set()
+
+# Callbacks called with the pubkey of every deleted key
+nwc_delete_listeners: list[Callable[[str], None]] = []
+
+# Budget held by the payments in flight (id -> spend, created_at), so that
+# the budget check does not have to wait for the payments to complete
+spend_holds: dict[int, tuple[TrackedSpendNWC, int]] = {}
+spend_hold_ids = count()
+
+
+async def load_registered_pubkeys() -> None:
+    rows = await db.fetchall("SELECT pubkey FROM nwcprovider.keys")
+    registered_pubkeys.clear()
+    registered_pubkeys.update(row["pubkey"] for row in rows)
+
+
+def is_registered_pubkey(pubkey: str) -> bool:
+    return pubkey in registered_pubkeys
+
 
 async def create_nwc(data: CreateNWCKey) -> NWCKey:
 
@@ -64,6 +89,7 @@ async def create_nwc(data: CreateNWCKey) -> NWCKey:
                 created_at=budget.created_at,
             )
             await db.insert("nwcprovider.budgets", budget_entry)
+    registered_pubkeys.add(data.pubkey)
     return NWCKey(**nwckey_entry.dict())
 
 
@@ -79,6 +105,14 @@ async def delete_nwc(data: DeleteNWC) -> None:
         "DELETE FROM nwcprovider.keys WHERE pubkey = :pubkey AND wallet = :wallet",
         {"pubkey": data.pubkey, "wallet": data.wallet},
     )
+    row = await db.fetchone(
+        "SELECT pubkey FROM nwcprovider.keys WHERE pubkey = :pubkey",
+        {"pubkey": data.pubkey},
+    )
+    if not row:
+        registered_pubkeys.discard(data.pubkey)
+        for listener in nwc_delete_listeners:
+            listener(data.pubkey)
 
 
 async def get_wallet_nwcs(data: GetWalletNWC) -> list[NWCKey]:
@@ -196,7 +230,16 @@ async def get_budgets_nwc(data: GetBudgetsNWC) -> list[NWCBudget]:
     return budgets
 
 
-async def tracked_spend_nwc(data: TrackedSpendNWC, action):
+async def reserve_spend_nwc(
+    data: TrackedSpendNWC, deadline: float | None = None
+) -> int | None:
+    """
+    Hold part of the budget of a client for a payment.
+
+    Returns:
+        int | None: The id of the hold, None if the payment is not in budget
+    """
+
     async def r():
 
         # hardening #
@@ -206,7 +249,6 @@ async def tracked_spend_nwc(data: TrackedSpendNWC, action):
 
         created_at = int(time.time())
         budgets = await get_budgets_nwc(GetBudgetsNWC(pubkey=data.pubkey))
-        in_budget = True
         for budget in budgets:
             last_cycle, next_cycle = budget.get_timestamp_range()
 
@@ -236,6 +278,13 @@ async def tracked_spend_nwc(data: TrackedSpendNWC, action):
                 )
                 or 0
             )
+            # payments in flight
+            tot_spent_in_range_msats += sum(
+                hold.amount_msats
+                for hold, hold_created_at in spend_holds.values()
+                if hold.pubkey == data.pubkey
+                and last_cycle <= hold_created_at < next_cycle
+            )
 
             # hardening #
             assert_valid_msats(tot_spent_in_range_msats)
@@ -243,25 +292,56 @@ async def tracked_spend_nwc(data: TrackedSpendNWC, action):
             # ## #
 
             if tot_spent_in_range_msats + data.amount_msats > budget.budget_msats:
-                in_budget = False
-                break
-        if not in_budget:
-            return False, None
-        out = await action()
-        await db.execute(
-            """
-            INSERT INTO nwcprovider.spent (pubkey, amount_msats, created_at)
-            VALUES (:pubkey, :amount_msats, :created_at)
-            """,
-            {
-                "pubkey": data.pubkey,
-                "amount_msats": data.amount_msats,
-                "created_at": created_at,
-            },
-        )
-        return True, out
+                return None
+        hold_id = next(spend_hold_ids)
+        spend_holds[hold_id] = (data, created_at)
+        return hold_id
+
+    # reservations of the same client are serialized, so that
+    # budgets are respected
+    return await enqueue(r, deadline, data.pubkey)
+
+
+async def commit_spend_nwc(hold_id: int):
+    """
+    Record the spend of a held payment that was sent.
+    """
+    data, created_at = spend_holds[hold_id]
+    await db.execute(
+        """
+        INSERT INTO nwcprovider.spent (pubkey, amount_msats, created_at)
+        VALUES (:pubkey, :amount_msats, :created_at)
+        """,
+        {
+            "pubkey": data.pubkey,
+            "amount_msats": data.amount_msats,
+            "created_at": created_at,
+        },
+    )
+    # the spend is counted only once it is stored
+    del spend_holds[hold_id]
 
-    return await enqueue(r)
+
+def release_spend_nwc(hold_id: int):
+    """
+    Give back the budget held for a payment that failed.
+    """
+    spend_holds.pop(hold_id, None)
+
+
+async def tracked_spend_nwc(
+    data: TrackedSpendNWC, action, deadline: float | None = None
+):
+    hold_id = await reserve_spend_nwc(data, deadline)
+    if hold_id is None:
+        return False, None
+    try:
+        out = await action()
+    except BaseException:
+        release_spend_nwc(hold_id)
+        raise
+    await commit_spend_nwc(hold_id)
+    return True, out
 
 
 async def get_config_nwc(key: str):
@@ -295,3 +375,69 @@ async def set_config_nwc(key: str, value: str):
 async def get_all_config_nwc():
     rows = await db.fetchall("SELECT * FROM nwcprovider.config", model=NWCConfig)
     return {row.key: row.value for row in rows}
+
+
+async def create_handled_nwc(event_id: str, created_at: int):
+
+    # hardening #
+    assert_valid_sha256(event_id)
+    assert_valid_timestamp_seconds(created_at)
+    # ## #
+
+    await db.execute(
+        """
+        INSERT INTO nwcprovider.handled (id, created_at)
+        VALUES (:id, :created_at)
+        ON CONFLICT (id) DO NOTHING;
+        """,
+        {"id": event_id, "created_at": created_at},
+    )
+
+
+async def get_handled_nwc(since: int) -> list[str]:
+
+    # hardening #
+    assert_valid_timestamp_seconds(since)
+    # ## #
+
+    rows = await db.fetchall(
+        "SELECT id FROM nwcprovider.handled WHERE created_at >= :since",
+        {"since": since},
+    )
+    return [row["id"] for row in rows]
+
+
+async def delete_handled_nwc(before: int):
+
+    # hardening #
+    assert_valid_timestamp_seconds(before)
+    # ## #
+
+    await db.execute(
+        "DELETE FROM nwcprovider.handled WHERE created_at < :before",
+        {"before": before},
+    )
+
+
+async def get_checkpoints_nwc() -> dict[str, int]:
+    rows = await db.fetchall("SELECT * FROM nwcprovider.checkpoints")
+    return {row["name"]: int(row["created_at"]) for row in rows}
+
+
+async def set_checkpoints_nwc(checkpoints: dict[str, int]):
+
+    # hardening #
+    for name, created_at in checkpoints.items():
+        assert_sane_string(name)
+        assert_valid_timestamp_seconds(created_at)
+    # ## #
+
+    for name, created_at in checkpoints.items():
+        await db.execute(
+            """
+            INSERT INTO nwcprovider.checkpoints (name, created_at)
+            VALUES (:name, :created_at)
+            ON CONFLICT (name) DO UPDATE SET created_at = EXCLUDED.created_at;
+            """,
+            {"name": name, "created_at": created_at},
+        )
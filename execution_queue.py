@@ -1,10 +1,59 @@
 import asyncio
+import time
 from typing import Any
 
-execution_queue: asyncio.Queue[dict[str, Any]] = asyncio.Queue()
+from .fair_queue import FairQueue
 
 
-async def enqueue(action):
+class ExpiredActionError(Exception):
+    """
+    Raised when an action reaches the head of the queue after its deadline
+    """
+
+
+class ExecutionQueue:
+    """
+    Run the queued actions on a pool of workers.
+    Actions with the same key (eg. the client pubkey that owns the budget)
+    run in order, one at a time, actions with different keys run concurrently.
+    """
+
+    def __init__(self):
+        self.queue = FairQueue()
+
+    def put(self, key: str, task: dict[str, Any]):
+        self.queue.put(key, task)
+
+    def get_pending_count(self) -> int:
+        """
+        Returns the number of tasks that are queued or running.
+        """
+        return self.queue.get_pending_count()
+
+    async def run_worker(self):
+        await self.queue.run_worker(self._run)
+
+    async def _run(self, task: dict[str, Any]):
+        action = task.get("action")
+        future = task.get("future")
+        deadline = task.get("deadline")
+        try:
+            if not action:
+                raise Exception("Invalid action")
+            if deadline and deadline <= time.time():
+                raise ExpiredActionError("Action expired while queued")
+            res = await action()
+            if future and not future.done():
+                future.set_result(res)
+        except Exception as e:
+            if future and not future.done():
+                future.set_exception(e)
+
+
+execution_queue = ExecutionQueue()
+
+
+async def enqueue(action, deadline: float | None = None, key: str = ""):
     future = asyncio.Future()
-    execution_queue.put_nowait({"action": action, "future": future})
+    execution_queue.put(key, {"action": action, "future": future, "deadline": deadline})
     return await future
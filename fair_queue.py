@@ -0,0 +1,59 @@
+import asyncio
+from collections import deque
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from loguru import logger
+
+
+class FairQueue:
+    """
+    Queue of items grouped by key, drained by a pool of workers.
+    Items with the same key are handled in order, one at a time,
+    items with different keys are handled concurrently. Keys take turns,
+    so that a busy key does not starve the others.
+    """
+
+    def __init__(self):
+        # Pending items for each key, the head of the queue is the item
+        # currently being handled (or the next one to be handled)
+        self.queues: dict[str, deque[Any]] = {}
+        # Keys that have items ready to be handled
+        self.ready: asyncio.Queue[str] = asyncio.Queue()
+
+    def put(self, key: str, item: Any):
+        """
+        Queue an item, after the other items with the same key.
+        """
+        queue = self.queues.get(key)
+        if queue is None:
+            self.queues[key] = deque([item])
+            self.ready.put_nowait(key)
+        else:
+            queue.append(item)
+
+    def get_pending_count(self) -> int:
+        """
+        Returns the number of items that are queued or being handled.
+        """
+        return sum(len(queue) for queue in self.queues.values())
+
+    async def run_worker(self, handler: Callable[[Any], Awaitable[None]]):
+        """
+        Handle the queued items until cancelled.
+        """
+        while True:
+            key = await self.ready.get()
+            queue = self.queues[key]
+            try:
+                await handler(queue[0])
+            except Exception as e:
+                logger.error("Error handling queued item: " + str(e))
+            finally:
+                queue.popleft()
+                if queue:
+                    # reschedule at the end of the ready queue, so that the
+                    # other keys get their turn
+                    self.ready.put_nowait(key)
+                else:
+                    del self.queues[key]
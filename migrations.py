@@ -1,3 +1,5 @@
+import time
+
 from coincurve import PrivateKey
 
 
@@ -119,3 +121,220 @@ async def m006_default_config3(db):
         """,
         {"value": "0"},
     )
+
+
+async def m007_default_config4(db):
+    """
+    Default config
+    """
+    await db.execute(
+        """
+        INSERT INTO nwcprovider.config (key, value)
+        VALUES ('max_concurrent_requests', :value)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+        """,
+        {"value": "8"},
+    )
+
+
+async def m008_default_config5(db):
+    """
+    Default config
+    """
+    await db.execute(
+        """
+        INSERT INTO nwcprovider.config (key, value)
+        VALUES ('max_tracked_requests', :value)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+        """,
+        {"value": "10000"},
+    )
+    await db.execute(
+        """
+        INSERT INTO nwcprovider.config (key, value)
+        VALUES ('max_tracked_requests_per_client', :value)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+        """,
+        {"value": "100"},
+    )
+
+
+async def m009_default_config6(db):
+    """
+    Default config
+    """
+    await db.execute(
+        """
+        INSERT INTO nwcprovider.config (key, value)
+        VALUES ('max_outbound_queue', :value)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+        """,
+        {"value": "1000"},
+    )
+
+
+async def m010_default_config7(db):
+    """
+    Default config
+    """
+    await db.execute(
+        """
+        INSERT INTO nwcprovider.config (key, value)
+        VALUES ('reconnect_base_delay', :value)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+        """,
+        {"value": "0.5"},
+    )
+    await db.execute(
+        """
+        INSERT INTO nwcprovider.config (key, value)
+        VALUES ('reconnect_max_delay', :value)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+        """,
+        {"value": "60"},
+    )
+    await db.execute(
+        """
+        INSERT INTO nwcprovider.config (key, value)
+        VALUES ('reconnect_stable_after', :value)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+        """,
+        {"value": "10"},
+    )
+    await db.execute(
+        """
+        INSERT INTO nwcprovider.config (key, value)
+        VALUES ('relay_ping_interval', :value)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+        """,
+        {"value": "30"},
+    )
+
+
+async def m011_checkpoints(db):
+    """
+    Checkpoints of the processed events
+    """
+    await db.execute(
+        """
+        CREATE TABLE nwcprovider.checkpoints (
+            name TEXT PRIMARY KEY,
+            created_at INTEGER NOT NULL
+        );
+        """
+    )
+
+
+async def m012_handled(db):
+    """
+    Journal of the handled requests
+    """
+    await db.execute(
+        """
+        CREATE TABLE nwcprovider.handled (
+            id TEXT PRIMARY KEY,
+            created_at INTEGER NOT NULL
+        );
+        """
+    )
+    await db.execute(
+        """
+        INSERT INTO nwcprovider.config (key, value)
+        VALUES ('subscribe_responses', :value)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+        """,
+        {"value": "0"},
+    )
+
+
+async def m013_default_config8(db):
+    """
+    Default config
+    """
+    await db.execute(
+        """
+        INSERT INTO nwcprovider.config (key, value)
+        VALUES ('response_ttl', :value)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+        """,
+        {"value": ""},
+    )
+    await db.execute(
+        """
+        INSERT INTO nwcprovider.config (key, value)
+        VALUES ('info_event_ttl', :value)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+        """,
+        {"value": "0"},
+    )
+
+
+async def m014_default_config9(db):
+    """
+    Default config
+    """
+    await db.execute(
+        """
+        INSERT INTO nwcprovider.config (key, value)
+        VALUES ('max_request_age', :value)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+        """,
+        {"value": "0"},
+    )
+
+
+async def m015_default_config10(db):
+    """
+    Default config
+    """
+    await db.execute(
+        """
+        INSERT INTO nwcprovider.config (key, value)
+        VALUES ('payment_timeout', :value)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+        """,
+        {"value": "60"},
+    )
+
+
+async def m016_default_config11(db):
+    """
+    Default config
+    """
+    await db.execute(
+        """
+        INSERT INTO nwcprovider.config (key, value)
+        VALUES ('execution_workers', :value)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+        """,
+        {"value": "4"},
+    )
+
+
+async def m017_default_config12(db):
+    """
+    Default config
+    """
+    await db.execute(
+        """
+        INSERT INTO nwcprovider.config (key, value)
+        VALUES ('multi_pay_concurrency', :value)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+        """,
+        {"value": "4"},
+    )
+
+
+async def m018_journal_started_at(db):
+    """
+    When the journal of the handled requests started, the past responses
+    are fetched from the relays until the journal covers the catch-up window
+    """
+    await db.execute(
+        """
+        INSERT INTO nwcprovider.config (key, value)
+        VALUES ('journal_started_at', :value)
+        ON CONFLICT (key) DO NOTHING;
+        """,
+        {"value": str(int(time.time()))},
+    )
@@ -0,0 +1,63 @@
+# NIP-04 encrypted direct messages
+#   https://github.com/nostr-protocol/nips/blob/master/04.md
+import base64
+import secrets
+
+from coincurve import PublicKey
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+
+def compute_shared_secret(private_key: bytes, public_key_hex: str) -> bytes:
+    """
+    Computes the ECDH shared secret (the x coordinate of the shared point).
+
+    Args:
+        private_key (bytes): The 32 bytes private key.
+        public_key_hex (str): The x-only public key of the other party.
+
+    Returns:
+        bytes: The 32 bytes shared secret.
+    """
+    public_key = PublicKey(b"\x02" + bytes.fromhex(public_key_hex))
+    return public_key.multiply(private_key).format()[1:33]
+
+
+def encrypt(shared_secret: bytes, message: str) -> str:
+    """
+    Encrypts a message with AES-256-CBC.
+
+    Args:
+        shared_secret (bytes): The shared secret.
+        message (str): The message to encrypt.
+
+    Returns:
+        str: The encrypted payload (base64 ciphertext + "?iv=" + base64 iv).
+    """
+    padder = padding.PKCS7(128).padder()
+    padded_data = padder.update(message.encode()) + padder.finalize()
+    iv = secrets.token_bytes(16)
+    encryptor = Cipher(algorithms.AES(shared_secret), modes.CBC(iv)).encryptor()
+    encrypted = encryptor.update(padded_data) + encryptor.finalize()
+    return base64.b64encode(encrypted).decode() + "?iv=" + base64.b64encode(iv).decode()
+
+
+def decrypt(shared_secret: bytes, payload: str) -> str:
+    """
+    Decrypts a payload encrypted with AES-256-CBC.
+
+    Args:
+        shared_secret (bytes): The shared secret.
+        payload (str): The encrypted payload.
+
+    Returns:
+        str: The decrypted message.
+    """
+    encrypted_b64, iv_b64 = payload.split("?iv=")
+    iv = base64.b64decode(iv_b64)
+    decryptor = Cipher(algorithms.AES(shared_secret), modes.CBC(iv)).decryptor()
+    padded_data = decryptor.update(base64.b64decode(encrypted_b64))
+    padded_data += decryptor.finalize()
+    unpadder = padding.PKCS7(128).unpadder()
+    data = unpadder.update(padded_data) + unpadder.finalize()
+    return data.decode()
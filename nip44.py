@@ -0,0 +1,137 @@
+# NIP-44 v2 encrypted payloads
+#   https://github.com/nostr-protocol/nips/blob/master/44.md
+import base64
+import hashlib
+import hmac
+import secrets
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms
+from cryptography.hazmat.primitives.kdf.hkdf import HKDFExpand
+
+from .nip04 import compute_shared_secret
+
+VERSION = 2
+MIN_PLAINTEXT_SIZE = 1
+MAX_PLAINTEXT_SIZE = 65535
+
+
+def get_conversation_key(private_key: bytes, public_key_hex: str) -> bytes:
+    """
+    Computes the conversation key between two parties, the same key is
+    used for all the messages exchanged in both directions.
+
+    Args:
+        private_key (bytes): The 32 bytes private key.
+        public_key_hex (str): The x-only public key of the other party.
+
+    Returns:
+        bytes: The 32 bytes conversation key.
+    """
+    shared_x = compute_shared_secret(private_key, public_key_hex)
+    return conversation_key_from_shared_secret(shared_x)
+
+
+def conversation_key_from_shared_secret(shared_x: bytes) -> bytes:
+    """
+    Derives the conversation key from the ECDH shared secret (HKDF-extract).
+    """
+    return hmac.new(b"nip44-v2", shared_x, hashlib.sha256).digest()
+
+
+def _get_message_keys(
+    conversation_key: bytes, nonce: bytes
+) -> tuple[bytes, bytes, bytes]:
+    keys = HKDFExpand(algorithm=hashes.SHA256(), length=76, info=nonce).derive(
+        conversation_key
+    )
+    # chacha key, chacha nonce, hmac key
+    return keys[0:32], keys[32:44], keys[44:76]
+
+
+def calc_padded_len(unpadded_len: int) -> int:
+    """
+    Returns the length of the padded plaintext.
+    """
+    if unpadded_len <= 32:
+        return 32
+    next_power = 1 << (unpadded_len - 1).bit_length()
+    chunk = 32 if next_power <= 256 else next_power // 8
+    return chunk * ((unpadded_len - 1) // chunk + 1)
+
+
+def _pad(plaintext: str) -> bytes:
+    data = plaintext.encode()
+    unpadded_len = len(data)
+    if unpadded_len < MIN_PLAINTEXT_SIZE or unpadded_len > MAX_PLAINTEXT_SIZE:
+        raise ValueError("Invalid plaintext length")
+    padding = calc_padded_len(unpadded_len) - unpadded_len
+    return unpadded_len.to_bytes(2, "big") + data + bytes(padding)
+
+
+def _unpad(padded: bytes) -> str:
+    unpadded_len = int.from_bytes(padded[0:2], "big")
+    data = padded[2 : 2 + unpadded_len]
+    if (
+        unpadded_len < MIN_PLAINTEXT_SIZE
+        or len(data) != unpadded_len
+        or len(padded) != 2 + calc_padded_len(unpadded_len)
+    ):
+        raise ValueError("Invalid padding")
+    return data.decode()
+
+
+def _chacha20(key: bytes, nonce: bytes, data: bytes) -> bytes:
+    # the 16 bytes nonce of the cryptography library is the 32 bit
+    # little endian block counter (0) followed by the 96 bit nonce
+    cipher = Cipher(algorithms.ChaCha20(key, bytes(4) + nonce), mode=None)
+    return cipher.encryptor().update(data)
+
+
+def encrypt(conversation_key: bytes, plaintext: str, nonce: bytes | None = None) -> str:
+    """
+    Encrypts a message.
+
+    Args:
+        conversation_key (bytes): The conversation key.
+        plaintext (str): The message to encrypt.
+        nonce (bytes): 32 bytes nonce (random if None, do not reuse).
+
+    Returns:
+        str: The base64 encoded payload.
+    """
+    nonce = nonce or secrets.token_bytes(32)
+    chacha_key, chacha_nonce, hmac_key = _get_message_keys(conversation_key, nonce)
+    ciphertext = _chacha20(chacha_key, chacha_nonce, _pad(plaintext))
+    mac = hmac.new(hmac_key, nonce + ciphertext, hashlib.sha256).digest()
+    return base64.b64encode(bytes([VERSION]) + nonce + ciphertext + mac).decode()
+
+
+def decrypt(conversation_key: bytes, payload: str) -> str:
+    """
+    Decrypts a message.
+
+    Args:
+        conversation_key (bytes): The conversation key.
+        payload (str): The base64 encoded payload.
+
+    Returns:
+        str: The decrypted message.
+    """
+    if not payload or payload[0] == "#":
+        raise ValueError("Unsupported encryption version")
+    if len(payload) < 132 or len(payload) > 87472:
+        raise ValueError("Invalid payload size")
+    data = base64.b64decode(payload)
+    if len(data) < 99 or len(data) > 65603:
+        raise ValueError("Invalid data size")
+    if data[0] != VERSION:
+        raise ValueError("Unsupported encryption version " + str(data[0]))
+    nonce = data[1:33]
+    ciphertext = data[33:-32]
+    mac = data[-32:]
+    chacha_key, chacha_nonce, hmac_key = _get_message_keys(conversation_key, nonce)
+    expected_mac = hmac.new(hmac_key, nonce + ciphertext, hashlib.sha256).digest()
+    if not hmac.compare_digest(mac, expected_mac):
+        raise ValueError("Invalid MAC")
+    return _unpad(_chacha20(chacha_key, chacha_nonce, ciphertext))
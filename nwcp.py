@@ -1,9 +1,14 @@
 import asyncio
 import hashlib
+import heapq
 import json
 import random
+import re
+import sys
 import time
+from collections import OrderedDict, deque
 from collections.abc import Awaitable, Callable
+from contextvars import ContextVar
 from typing import Any, Union
 
 from coincurve import PublicKeyXOnly
@@ -13,79 +18,748 @@ from loguru import logger
 from pynostr.key import PrivateKey
 from websockets.legacy.client import connect
 
+from . import nip04, nip44
+from .fair_queue import FairQueue
+
+try:
+    import orjson
+
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# Expected types of the fields of a nostr event
+EVENT_FIELDS: dict[str, type] = {
+    "id": str,
+    "pubkey": str,
+    "created_at": int,
+    "kind": int,
+    "tags": list,
+    "content": str,
+    "sig": str,
+}
+MAX_EVENT_CONTENT_SIZE = 512 * 1024
+MAX_EVENT_TAGS = 100
+
+# Supported encryption schemes, in order of preference
+SUPPORTED_ENCRYPTIONS = ["nip44_v2", "nip04"]
+
+# Deadline (unix time) of the request being handled, the client
+# is not waiting for the response anymore after that
+request_deadline: ContextVar[float | None] = ContextVar(
+    "request_deadline", default=None
+)
+
+
+def get_request_deadline() -> float | None:
+    """
+    Returns the deadline of the request being handled, if any.
+    """
+    return request_deadline.get()
+
+
+def _has_float(data: Any) -> bool:
+    data_type = type(data)
+    if data_type is float:
+        return True
+    if data_type is list or data_type is tuple:
+        for value in data:
+            if _has_float(value):
+                return True
+    elif data_type is dict:
+        for value in data.values():
+            if _has_float(value):
+                return True
+    return False
+
+
+# Runs of digits that may be integers wider than 64 bits (19 digits already
+# go below -2**63), orjson parses them as floats (losing precision)
+# instead of failing
+BIG_INT_PATTERN = re.compile(r"\d{19,}")
+BIG_INT_PATTERN_BYTES = re.compile(rb"\d{19,}")
+
+
+class JSONCodec:
+    """
+    Compact JSON encoder/decoder for the relay messages.
+    Uses orjson when it is installed and falls back to the standard library.
+    The output is always byte-identical to
+    json.dumps(data, separators=(",", ":"), ensure_ascii=False),
+    since it is used to compute the event ids.
+    """
+
+    def __init__(self, use_orjson: bool = HAS_ORJSON):
+        self.use_orjson = use_orjson and HAS_ORJSON
+
+    def loads(self, data: str | bytes) -> Any:
+        """
+        Parses a JSON document.
+        """
+        if self.use_orjson:
+            pattern = (
+                BIG_INT_PATTERN_BYTES if isinstance(data, bytes) else BIG_INT_PATTERN
+            )
+            if not pattern.search(data):  # type: ignore[arg-type]
+                try:
+                    return orjson.loads(data)
+                except ValueError:
+                    # eg. NaN
+                    pass
+        return json.loads(data)
+
+    def dumps_bytes(self, data: Any) -> bytes:
+        """
+        Serializes data to compact utf-8 encoded JSON.
+        """
+        # orjson formats floats differently (eg. 1e16 vs 1e+16)
+        if self.use_orjson and not _has_float(data):
+            try:
+                return orjson.dumps(data)
+            except TypeError:
+                # eg. integers that do not fit 64 bits or invalid strings
+                pass
+        return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode()
+
+    def dumps(self, data: Any) -> str:
+        """
+        Serializes data to a compact JSON string.
+        """
+        return self.dumps_bytes(data).decode()
+
+
+json_codec = JSONCodec()
+
+
+class PendingPublish:
+    """
+    An event published to the relay that was not acknowledged yet.
+    """
+
+    __slots__ = ("attempts", "frame", "next_retry_at", "published_at")
+
+    def __init__(self, frame: str = ""):
+        self.frame = frame
+        self.attempts = 1
+        self.published_at = time.monotonic()
+        # when to retry if no OK message is received (set when sent)
+        self.next_retry_at: float | None = None
+
 
 class RateLimit:
     backoff: int = 0
     last_attempt_time: int = 0
 
 
-class MainSubscription:
+class RelayHealth:
+    """
+    Health of a relay connection, measured from the connection attempts.
+    """
+
     def __init__(self):
-        self.requests_sub_id: str | None = None
-        self.responses_sub_id: str | None = None
-        self.requests_eose = False
-        self.responses_eose = False
-        self.events: dict[str, dict] = {}
-        self.responses: list[str] = []
+        # moving averages (seconds)
+        self.connect_latency: float = 0.0
+        self.ping_rtt: float = 0.0
+        # failed attempts since the last stable connection
+        self.consecutive_failures: int = 0
+        self.failures: int = 0
+        self.connects: int = 0
+        self.connected_at: float = 0.0
+        # last reconnect delay (used by the decorrelated jitter)
+        self.last_delay: float = 0.0
+
+    @staticmethod
+    def _average(current: float, sample: float, weight: float = 0.3) -> float:
+        return sample if current == 0 else current + (sample - current) * weight
+
+    def on_connected(self, latency: float):
+        self.connects += 1
+        self.connected_at = time.monotonic()
+        self.connect_latency = self._average(self.connect_latency, latency)
+
+    def on_ping(self, rtt: float):
+        self.ping_rtt = self._average(self.ping_rtt, rtt)
+
+    def on_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+
+    def on_closed(self, stable_after: float) -> bool:
+        """
+        Called when an established connection is closed.
+
+        Args:
+            stable_after (float): Seconds after which a connection is stable
+
+        Returns:
+            bool: True if the connection was stable (clean close)
+        """
+        if time.monotonic() - self.connected_at >= stable_after:
+            self.consecutive_failures = 0
+            self.last_delay = 0
+            return True
+        # the relay drops the connections right after accepting them
+        self.on_failure()
+        return False
+
+    def score(self) -> float:
+        """
+        Returns the health score of the relay, from 1 (healthy) towards 0.
+        """
+        return 1 / (
+            (1 + self.consecutive_failures) * (1 + self.connect_latency + self.ping_rtt)
+        )
+
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            "score": round(self.score(), 3),
+            "connect_latency_ms": round(self.connect_latency * 1000, 1),
+            "ping_rtt_ms": round(self.ping_rtt * 1000, 1),
+            "consecutive_failures": self.consecutive_failures,
+            "failures": self.failures,
+            "connects": self.connects,
+        }
+
+
+class ReconnectPolicy:
+    """
+    Reconnect delays with decorrelated jitter, scaled by the relay health.
+    """
+
+    def __init__(
+        self,
+        base_delay: float = 0.5,
+        max_delay: float = 60,
+        stable_after: float = 10,
+        ping_interval: float = 30,
+        ping_timeout: float = 10,
+    ):
+        self.base_delay = max(0.1, base_delay)
+        self.max_delay = max(self.base_delay, max_delay)
+        # seconds after which a connection is considered stable
+        self.stable_after = stable_after
+        # websocket keepalive ping, used to measure the latency (0 to disable)
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+
+    def next_delay(self, health: RelayHealth, clean_close: bool) -> float:
+        """
+        Returns the number of seconds to wait before reconnecting.
+
+        Args:
+            health (RelayHealth): The health of the relay
+            clean_close (bool): True if a stable connection was closed
+
+        Returns:
+            float: The delay in seconds (0 to reconnect immediately)
+        """
+        if clean_close and health.consecutive_failures == 0:
+            return 0
+        # unhealthy relays are retried less aggressively
+        floor = min(self.base_delay / health.score(), self.max_delay)
+        ceiling = max(floor, health.last_delay * 3)
+        delay = min(self.max_delay, random.uniform(floor, ceiling))
+        health.last_delay = delay
+        return delay
+
+
+class LRUCache:
+    """
+    Least recently used cache with an optional time to live.
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: int = 0):
+        self.max_size = max(1, max_size)
+        # seconds after which an entry expires (0 to disable)
+        self.ttl = ttl
+        self.entries: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Any) -> Any | None:
+        """
+        Returns the cached value for key, or None if missing or expired.
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            if not self.ttl or time.monotonic() - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def set(self, key: Any, value: Any):
+        """
+        Caches value for key, evicting the least recently used entry if full.
+        """
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def remove(self, key: Any):
+        """
+        Removes key from the cache.
+        """
+        self.entries.pop(key, None)
+
+    def get_stats(self) -> dict[str, int]:
+        """
+        Returns the size of the cache and its hit/miss counters.
+        """
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+class RequestDispatcher:
+    """
+    Dispatch requests to a bounded pool of async workers.
+    Requests from the same client pubkey are handled in order, one at a time,
+    requests from different clients are handled concurrently.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[dict], Awaitable[Any]],
+        max_concurrency: int = 8,
+        max_pending: int = 10000,
+    ):
+        self.handler = handler
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_pending = max_pending
+        # Pending requests by client pubkey
+        self.queue = FairQueue()
+        # Ids of the requests that are queued or being handled
+        self.queued_ids: set[str] = set()
+        self.workers: list[asyncio.Task] = []
+
+    def start(self):
+        """
+        Start the workers.
+        """
+        for _ in range(self.max_concurrency - len(self.workers)):
+            self.workers.append(
+                asyncio.create_task(self.queue.run_worker(self._handle))
+            )
+
+    def stop(self):
+        """
+        Stop the workers.
+        """
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+
+    def get_pending_count(self) -> int:
+        """
+        Returns the number of requests that are queued or being handled.
+        """
+        return len(self.queued_ids)
+
+    def dispatch(self, event: dict) -> bool:
+        """
+        Queue a request to be handled by the workers.
+
+        Args:
+            event (Dict): The request event.
+
+        Returns:
+            bool: True if the request was queued, False if it was already queued
+                  or the dispatcher is full.
+        """
+        event_id = event["id"]
+        if event_id in self.queued_ids:
+            return False
+        if len(self.queued_ids) >= self.max_pending:
+            logger.warning("Too many pending requests, dropping " + event_id)
+            return False
+        self.queued_ids.add(event_id)
+        self.queue.put(event["pubkey"], event)
+        return True
+
+    async def _handle(self, event: dict):
+        try:
+            await self.handler(event)
+        except Exception as e:
+            logger.error("Error handling request: " + str(e))
+        finally:
+            self.queued_ids.discard(event["id"])
+
+
+class TrackedRequest:
+    """
+    Compact record of a tracked request event.
+    """
+
+    __slots__ = ("created_at", "id", "pubkey", "responded")
+
+    def __init__(self, event_id: str, created_at: int, pubkey: str):
+        self.id = event_id
+        self.created_at = created_at
+        self.pubkey = pubkey
+        self.responded = False
+
+
+class RequestStore:
+    """
+    Indexed store of the tracked request events and their responses,
+    with bounded retention.
+    """
+
+    def __init__(self, max_events: int = 10000, max_events_per_client: int = 100):
+        self.max_events = max(1, max_events)
+        self.max_events_per_client = max(1, max_events_per_client)
+        # All the tracked request events
+        self.events: dict[str, TrackedRequest] = {}
+        # Full payload of the tracked events that are waiting to be processed
+        self.payloads: dict[str, dict] = {}
+        # Responses to untracked requests and when they were registered
+        #   (eg. responses received before the request)
+        self.responses: dict[str, int] = {}
+        # Ids of the tracked events of each client pubkey (oldest first)
+        self.clients: dict[str, dict[str, None]] = {}
+        # (created_at, event_id) heap of the tracked events, used for expiration
+        #   Note: entries of removed events are dropped lazily
+        self.events_index: list[tuple[int, str]] = []
+        # (registered_at, event_id) heap of the responses, used for expiration
+        self.responses_index: list[tuple[int, str]] = []
+        # Number of evicted events for each reason
+        self.evicted: dict[str, int] = {"global_cap": 0, "client_cap": 0, "expired": 0}
+        # created_at of the newest request that was processed or responded
+        self.newest_processed = 0
+
+    def add(self, event: dict):
+        """
+        Track a request event, evicting older events if the store is full
+        """
+        event_id = event["id"]
+        if event_id in self.events:
+            return
+        pubkey = sys.intern(event["pubkey"])
+        client = self.clients.get(pubkey)
+        if client and len(client) >= self.max_events_per_client:
+            self._evict(next(iter(client)), "client_cap")
+        elif len(self.events) >= self.max_events:
+            self._evict_oldest("global_cap")
+        if len(self.events_index) > 2 * len(self.events) + 1000:
+            self._rebuild_index()
+        record = TrackedRequest(event_id, event["created_at"], pubkey)
+        self.events[event_id] = record
+        self.clients.setdefault(pubkey, {})[event_id] = None
+        heapq.heappush(self.events_index, (record.created_at, event_id))
+        if self.responses.pop(event_id, None) is not None:
+            record.responded = True
+        else:
+            self.payloads[event_id] = event
+
+    def mark_responded(self, event_id: str):
+        """
+        Register a response for a request event (not pending anymore)
+        """
+        record = self.events.get(event_id)
+        if record:
+            record.responded = True
+            self.payloads.pop(event_id, None)
+            self._on_processed(record)
+        elif event_id not in self.responses:
+            self._add_response(event_id)
+
+    def mark_processed(self, event_id: str):
+        """
+        Drop the payload of a request that was processed, even if it didn't
+        get a response (eg. it failed), so that it is not processed again
+        """
+        if self.payloads.pop(event_id, None) is not None:
+            self._on_processed(self.events[event_id])
+
+    def _on_processed(self, record: TrackedRequest):
+        # clients can date requests in the future, the checkpoint must not
+        # get ahead of now or the live requests would not be fetched anymore
+        created_at = min(record.created_at, int(time.time()))
+        self.newest_processed = max(self.newest_processed, created_at)
+
+    def get_checkpoint(self) -> int:
+        """
+        Returns the created_at of the oldest request waiting to be processed,
+        or of the newest processed request if none is waiting (0 if unknown).
+        All the requests older than the checkpoint were processed.
+        """
+        if not self.payloads:
+            return self.newest_processed
+        oldest = min(event["created_at"] for event in self.payloads.values())
+        return min(oldest, int(time.time()))
 
-    def get_stale(self) -> list[dict]:
+    def is_pending(self, event_id: str) -> bool:
         """
-        Get all the pending events that do not have a response yet.
+        Returns True if a tracked event is waiting to be processed.
         """
-        pending_events = []
-        for [event_id, event] in self.events.items():
-            if event_id not in self.responses:
-                pending_events.append(event)
-        return pending_events
+        return event_id in self.payloads
 
-    def register_response(self, event_id: str):
+    def get_payload(self, event_id: str) -> dict | None:
         """
-        Register a response for a request event (not stale anymore)
+        Returns a tracked event if it is waiting to be processed.
         """
-        if event_id not in self.responses:
-            self.responses.append(event_id)
+        return self.payloads.get(event_id)
 
-    def gc(self, expire: int | None = None):
+    def get_pending(self) -> list[dict]:
         """
-        Garbage collection, remove all the events that have a response older
-        than expire seconds (defaults to 1 hour if 0 or None)
+        Get all the tracked events that are waiting to be processed.
         """
-        expire = expire or 1 * 60 * 60
+        return list(self.payloads.values())
+
+    def gc(self, expire: int) -> int:
+        """
+        Remove all the events older than expire seconds, and all the responses
+        to untracked events registered more than expire seconds ago.
+        Events that never got a response are counted as evicted.
+
+        Returns:
+            int: The number of removed events.
+        """
+        cutoff = int(time.time()) - expire
+        deleted = 0
+        while self.events_index and self.events_index[0][0] < cutoff:
+            event_id = heapq.heappop(self.events_index)[1]
+            record = self.events.get(event_id)
+            if not record:
+                continue
+            if record.responded:
+                self._remove(record)
+            else:
+                self._evict(event_id, "expired")
+            deleted += 1
+        while self.responses_index and self.responses_index[0][0] < cutoff:
+            event_id = heapq.heappop(self.responses_index)[1]
+            self.responses.pop(event_id, None)
+        return deleted
+
+    def _add_response(self, event_id: str):
         now = int(time.time())
-        deleted_ids = []
-        for event_id, event in list(self.events.items()):
-            if event_id in self.responses:
-                if now - event["created_at"] > expire:
-                    del self.events[event_id]
-                    deleted_ids.append(event_id)
-        self.responses = [
-            event_id for event_id in self.responses if event_id not in deleted_ids
+        self.responses[event_id] = now
+        heapq.heappush(self.responses_index, (now, event_id))
+
+    def _remove(self, record: TrackedRequest):
+        del self.events[record.id]
+        self.payloads.pop(record.id, None)
+        client = self.clients.get(record.pubkey)
+        if client is not None:
+            client.pop(record.id, None)
+            if not client:
+                del self.clients[record.pubkey]
+
+    def _evict(self, event_id: str, reason: str):
+        record = self.events.get(event_id)
+        if not record:
+            return
+        self._remove(record)
+        if record.responded:
+            # keep the response, so that the request is not handled again
+            # if it is received again
+            self._add_response(event_id)
+        self.evicted[reason] += 1
+
+    def _evict_oldest(self, reason: str):
+        while self.events_index:
+            event_id = heapq.heappop(self.events_index)[1]
+            if event_id in self.events:
+                self._evict(event_id, reason)
+                return
+
+    def _rebuild_index(self):
+        self.events_index = [
+            (record.created_at, event_id) for event_id, record in self.events.items()
         ]
+        heapq.heapify(self.events_index)
+
+
+class Subscription:
+    """
+    A subscription to a relay, that can be resumed from the last seen event
+    if it is closed by the relay.
+    """
+
+    def __init__(self, sub_id: str, filters: dict):
+        self.sub_id = sub_id
+        self.filters = filters
+        self.eose = False
+        # created_at of the newest event received after the eose
+        self.last_seen = 0
+
+    def on_event(self, created_at: int):
+        # the stored events can be received in any order (usually newest
+        # first), only the events after the eose move the resume point
+        if not self.eose:
+            return
+        # events from the future do not move the resume point forward
+        created_at = min(created_at, int(time.time()))
+        if created_at > self.last_seen:
+            self.last_seen = created_at
+
+    def get_resume_filters(self) -> dict:
+        """
+        Returns the filters to resubscribe from the last seen event.
+        """
+        if not self.eose or self.last_seen <= self.filters.get("since", 0):
+            return self.filters
+        return {**self.filters, "since": self.last_seen}
 
-        if len(deleted_ids) > 0:
-            logger.debug("Garbage collected " + str(len(deleted_ids)) + " events")
+
+class MainSubscription:
+    def __init__(self, requests: Subscription, responses: Subscription | None = None):
+        self.requests = requests
+        # Optional, the handled requests can be tracked locally instead
+        self.responses = responses
+        # Ids of the requests received before the eose, they are handled
+        # when both eose are received
+        self.catchup_ids: list[str] = []
+
+    def get(self, sub_id: Any) -> Subscription | None:
+        """
+        Returns the subscription with the given id.
+        """
+        for sub in self.get_all():
+            if sub.sub_id == sub_id:
+                return sub
+        return None
+
+    def get_all(self) -> list[Subscription]:
+        """
+        Returns the active subscriptions.
+        """
+        if self.responses:
+            return [self.requests, self.responses]
+        return [self.requests]
+
+    def is_caught_up(self) -> bool:
+        """
+        Returns True if the eose was received for all the subscriptions.
+        """
+        return all(sub.eose for sub in self.get_all())
 
     class Config:
         arbitrary_types_allowed = True
 
 
+def split_relays(relays: str | list[str] | None) -> list[str]:
+    """
+    Splits a comma (or whitespace) separated list of relays.
+
+    Args:
+        relays (str | List[str]): The relays
+
+    Returns:
+        List[str]: The relays, without duplicates
+    """
+    if not relays:
+        return []
+    if isinstance(relays, str):
+        relays = relays.replace(",", " ").split()
+    out: list[str] = []
+    for relay in relays:
+        relay = relay.strip()
+        if relay and relay not in out:
+            out.append(relay)
+    return out
+
+
+class RelayConnection:
+    """
+    Connection to one of the relays used by the service provider,
+    with its own subscription, outbound queue and health.
+    """
+
+    def __init__(self, url: str, max_outbound_queue: int = 1000):
+        self.url = url
+        # websocket connection
+        self.ws = None
+        # set when the websocket is connected and the subscriptions are
+        # in place, cleared when the connection is lost
+        self.ready = asyncio.Event()
+        self.sub: MainSubscription | None = None
+        self.health = RelayHealth()
+        self.rate_limit: dict[str, RateLimit] = {}
+
+        # Outbound (frame, event id) pairs, sent by the writer task as soon as
+        # the connection is available (bounded, senders wait when it is full)
+        self.outbox: asyncio.Queue[tuple[str, str | None]] = asyncio.Queue(
+            maxsize=max_outbound_queue
+        )
+        # Frames taken from the outbox that were not sent yet
+        # (eg. the connection was lost), they are sent again after reconnecting
+        self.unsent: deque[tuple[str, str | None]] = deque()
+        # Frames dropped because the relay was down and its queue was full
+        self.dropped = 0
+
+        # Published events waiting for an OK message from this relay
+        self.pending_publishes: dict[str, PendingPublish] = {}
+        # True once the relay sent an OK message, relays that never
+        # acknowledge events are not retried on timeout
+        self.sends_ok = False
+
+        # Writer and reconnect tasks
+        self.tasks: list[asyncio.Task] = []
+
+    @property
+    def connected(self) -> bool:
+        """
+        True if the websocket is connected and ready to be used.
+        """
+        return self.ready.is_set()
+
+    @connected.setter
+    def connected(self, value: bool):
+        if value:
+            self.ready.set()
+        else:
+            self.ready.clear()
+
+    def get_outbound_queue_size(self) -> int:
+        """
+        Returns the number of frames waiting to be sent.
+        """
+        return self.outbox.qsize() + len(self.unsent)
+
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            "connected": self.connected,
+            "outbound_queue": self.get_outbound_queue_size(),
+            "dropped_frames": self.dropped,
+            "pending_publishes": len(self.pending_publishes),
+            **self.health.get_stats(),
+        }
+
+
 class NWCServiceProvider:
     def __init__(
         self,
         private_key_hex: str | None = None,
-        relay: str | None = None,
+        relay: str | list[str] | None = None,
         handle_missed_events: int = 0,
+        max_concurrent_requests: int = 8,
+        max_tracked_requests: int = 10000,
+        max_tracked_requests_per_client: int = 100,
+        max_outbound_queue: int = 1000,
+        publish_ack_timeout: int = 10,
+        publish_max_attempts: int = 3,
+        reconnect_policy: ReconnectPolicy | None = None,
+        checkpoints: dict[str, int] | None = None,
+        checkpoint_skew: int = 60,
+        handled_requests: list[str] | None = None,
+        subscribe_responses: bool = True,
+        response_ttl: int | None = None,
+        info_event_ttl: int = 0,
+        max_request_age: int = 0,
     ):
-        if not relay:  # Connect to nostrclient
-            relay = "nostrclient"
-        if relay == "nostrclient":
-            relay = f"ws://localhost:{settings.port}/nostrclient/api/v1/relay"
-        elif relay == "nostrclient:private":
-            relay_endpoint = encrypt_internal_message("relay")
-            relay = (
-                f"ws://localhost:{settings.port}/nostrclient/api/v1/{relay_endpoint}"
-            )
-        self.relay = relay
+        # Relays (comma separated), requests are received from all of them
+        # and responses are published to all of them
+        relay_urls = [
+            self._get_relay_url(url) for url in split_relays(relay) or ["nostrclient"]
+        ]
+        self.relays = [
+            RelayConnection(url, max_outbound_queue)
+            for url in dict.fromkeys(relay_urls)
+        ]
 
         if not private_key_hex:  # Create random key
             self.private_key = PrivateKey()
@@ -99,6 +773,12 @@ class NWCServiceProvider:
             raise Exception("Invalid public key")
 
         self.public_key_hex = self.public_key.hex()
+        self.private_key_bytes = bytes.fromhex(self.private_key_hex)
+
+        # ECDH shared secrets (nip04) and conversation keys (nip44)
+        # of the recently seen clients
+        self.shared_secrets = LRUCache(max_size=10000)
+        self.conversation_keys = LRUCache(max_size=10000)
 
         # List of supported methods
         self.supported_methods: list[str] = []
@@ -115,8 +795,15 @@ class NWCServiceProvider:
             ],
         ] = {}
 
-        # Reconnect task (if the connection is lost)
-        self.reconnect_task = None
+        # Dispatch requests to a pool of workers, so that slow requests
+        # do not block the connection
+        self.dispatcher = RequestDispatcher(
+            self._process_request, max_concurrent_requests
+        )
+
+        # Filter of the known client pubkeys, requests from other clients
+        # are rejected before decrypting them (None to accept all)
+        self.client_filter: Callable[[str], bool] | None = None
 
         # Garbage collection loop
         self.gc_task = None
@@ -124,15 +811,33 @@ class NWCServiceProvider:
         # Periodic info event resend loop
         self.info_event_task = None
 
-        # Subscription
-        self.sub = None
-        self.rate_limit: dict[str, RateLimit] = {}
+        # Published events are tracked until each relay acknowledges them
+        self.publish_ack_timeout = publish_ack_timeout
+        self.publish_max_attempts = publish_max_attempts
+        self.publish_stats: dict[str, Any] = {
+            "acked": 0,
+            "rejected": 0,
+            "retried": 0,
+            "failed": 0,
+            "ack_latency_avg_ms": 0.0,
+            "ack_latency_max_ms": 0.0,
+        }
+        self.publish_retry_task = None
 
-        # websocket connection
-        self.ws = None
+        # Recently verified events, so that events received again
+        # (eg. after a resubscription) are not verified again
+        self.verified_events = LRUCache(max_size=4096, ttl=10 * 60)
+
+        # Number of rejected incoming events for each validation stage
+        self.rejected_events: dict[str, int] = {}
+
+        # Tracked requests and responses (used to find stale requests)
+        self.requests = RequestStore(
+            max_tracked_requests, max_tracked_requests_per_client
+        )
 
-        # if True the websocket is connected
-        self.connected = False
+        # When to reconnect, based on the health of each relay
+        self.reconnect_policy = reconnect_policy or ReconnectPolicy()
 
         # if True the instance is shutting down
         self.shutdown = False
@@ -142,19 +847,102 @@ class NWCServiceProvider:
         #   (handles reboots)
         self.handle_missed_events = handle_missed_events
 
+        # created_at of the last processed request and of the newest
+        # response, missed events are fetched only from there (minus
+        # checkpoint_skew seconds, to tolerate out of order events)
+        self.checkpoints: dict[str, int] = {"requests": 0, "responses": 0}
+        self.checkpoints.update(checkpoints or {})
+        self.checkpoint_skew = checkpoint_skew
+        # Called with the checkpoints when they change, to store them
+        self.checkpoint_listener: Callable[[dict[str, int]], Awaitable[None]] | None = (
+            None
+        )
+        self.saved_checkpoints = dict(self.checkpoints)
+        # created_at of the newest response, it becomes the checkpoint
+        # once the stored events were received
+        self.newest_response = 0
+        self.checkpoint_task = None
+
+        # Journal of the handled requests, used to find the stale requests
+        # instead of fetching our own responses again from the relays
+        self.journal_append: Callable[[str, int], Awaitable[None]] | None = None
+        self.journal_prune: Callable[[int], Awaitable[None]] | None = None
+        for event_id in handled_requests or []:
+            self.requests.mark_responded(event_id)
+        # if False the responses are not fetched from the relays
+        # (use it only with a journal)
+        self.subscribe_responses = subscribe_responses
+
+        # Published events expire (nip 40) after these many seconds, so that
+        # relays can drop them (0 to disable). The responses expire by default
+        # after handle_missed_events (or 10 minutes), when they are no longer
+        # needed to find the stale requests
+        if response_ttl is None:
+            response_ttl = max(handle_missed_events, 600)
+        self.response_ttl = response_ttl
+        self.info_event_ttl = info_event_ttl
+
+        # Requests are dropped if they are not handled before they expire
+        # (nip 40) or before they are max_request_age seconds old (0 to disable)
+        self.max_request_age = max_request_age
+        self.expired_requests = 0
+
         logger.info(
-            "NWC Service is ready. relay: "
-            + str(self.relay)
+            "NWC Service is ready. relays: "
+            + ", ".join(relay.url for relay in self.relays)
             + " pubkey: "
             + self.public_key_hex
         )
 
+    @staticmethod
+    def _get_relay_url(relay: str) -> str:
+        """
+        Returns the websocket url of a relay (resolves the nostrclient aliases).
+        """
+        if relay == "nostrclient":
+            return f"ws://localhost:{settings.port}/nostrclient/api/v1/relay"
+        if relay == "nostrclient:private":
+            relay_endpoint = encrypt_internal_message("relay")
+            return f"ws://localhost:{settings.port}/nostrclient/api/v1/{relay_endpoint}"
+        return relay
+
     async def _gc_loop(self):
         while not self._is_shutting_down():
-            if self.sub:
-                self.sub.gc(self.handle_missed_events)
+            # remove all the events older than handle_missed_events
+            # seconds (defaults to 1 hour if 0)
+            expire = self.handle_missed_events or 1 * 60 * 60
+            deleted = self.requests.gc(expire)
+            if deleted > 0:
+                logger.debug("Garbage collected " + str(deleted) + " events")
+            if self.journal_prune:
+                try:
+                    cutoff = int(time.time()) - expire - self.checkpoint_skew
+                    await self.journal_prune(cutoff)
+                except Exception as e:
+                    logger.warning("Error pruning the journal: " + str(e))
             await asyncio.sleep(60)
 
+    def get_stats(self) -> dict[str, Any]:
+        """
+        Returns runtime statistics of this service provider.
+        """
+        return {
+            "pending_requests": self.dispatcher.get_pending_count(),
+            "tracked_requests": len(self.requests.events),
+            "evicted_requests": dict(self.requests.evicted),
+            "verified_events_cache": self.verified_events.get_stats(),
+            "shared_secrets_cache": self.shared_secrets.get_stats(),
+            "conversation_keys_cache": self.conversation_keys.get_stats(),
+            "rejected_events": dict(self.rejected_events),
+            "expired_requests": self.expired_requests,
+            "outbound_queue": self.get_outbound_queue_size(),
+            "publish": {
+                **self.publish_stats,
+                "pending": sum(len(r.pending_publishes) for r in self.relays),
+            },
+            "relays": {relay.url: relay.get_stats() for relay in self.relays},
+        }
+
     def get_supported_methods(self):
         """
         Returns the list of supported methods by this service provider.
@@ -182,13 +970,60 @@ class NWCServiceProvider:
             self.supported_methods.append(method)
         self.request_listeners[method] = listener
 
+    def set_checkpoint_listener(
+        self, listener: Callable[[dict[str, int]], Awaitable[None]] | None
+    ):
+        """
+        Sets a listener called with the checkpoints every time they change,
+        so that they can be stored and passed back on the next start.
+
+        Args:
+            listener (Callable[[Dict[str, int]], Awaitable[None]]): The listener
+        """
+        self.checkpoint_listener = listener
+
+    def set_journal(
+        self,
+        append: Callable[[str, int], Awaitable[None]] | None,
+        prune: Callable[[int], Awaitable[None]] | None = None,
+    ):
+        """
+        Sets the journal of the handled requests.
+
+        Args:
+            append (Callable[[str, int], Awaitable[None]]): Called with the id
+                and created_at of every request before it is handled
+            prune (Callable[[int], Awaitable[None]]): Called periodically to
+                remove the requests created before the given timestamp
+        """
+        self.journal_append = append
+        self.journal_prune = prune
+
+    def set_client_filter(self, client_filter: Callable[[str], bool] | None):
+        """
+        Sets a filter of the known client pubkeys. Requests from unknown
+        clients are dropped without being decrypted.
+
+        Args:
+            client_filter (Callable[[str], bool]): Returns True if the given
+                client pubkey is known (None to accept all the clients)
+        """
+        self.client_filter = client_filter
+
     async def start(self):
         """
         Starts the NWC service provider.
         """
-        self.reconnect_task = asyncio.create_task(self._connect_to_relay())
+        self.dispatcher.start()
+        for relay in self.relays:
+            relay.tasks = [
+                asyncio.create_task(self._writer_loop(relay)),
+                asyncio.create_task(self._connect_to_relay(relay)),
+            ]
+        self.publish_retry_task = asyncio.create_task(self._publish_retry_loop())
         self.gc_task = asyncio.create_task(self._gc_loop())
         self.info_event_task = asyncio.create_task(self._info_event_loop())
+        self.checkpoint_task = asyncio.create_task(self._checkpoint_loop())
 
     def _json_dumps(self, data: Union[dict, list]) -> str:
         """
@@ -202,7 +1037,7 @@ class NWCServiceProvider:
         """
         if isinstance(data, dict):
             data = {k: v for k, v in data.items() if v is not None}
-        return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+        return json_codec.dumps(data)
 
     def _is_shutting_down(self) -> bool:
         """
@@ -210,21 +1045,167 @@ class NWCServiceProvider:
         """
         return self.shutdown or not settings.lnbits_running
 
-    async def _send(self, data: list[Any]):
+    async def _send(self, data: list[Any], relays: list[RelayConnection] | None = None):
         """
-        Sends data to the relay.
+        Queues data to be sent to the relays, waits only if the outbound
+        queue of a connected relay is full.
 
         Args:
             data (Dict): The data to be sent.
+            relays (List[RelayConnection]): The relays (all if None)
         """
-        if not self.ws:
-            raise Exception("Websocket connection is not established")
         if self._is_shutting_down():
             logger.warning("Trying to send data while shutting down")
             return
-        await self._wait_for_connection()  # ensure the connection is established
         tx = self._json_dumps(data)
-        await self.ws.send(tx)
+        event_id = data[1].get("id") if data[0] == "EVENT" else None
+        full: list[RelayConnection] = []
+        for relay in relays or self.relays:
+            pending = relay.pending_publishes.get(event_id) if event_id else None
+            if pending:
+                pending.frame = tx
+            if not relay.outbox.full():
+                relay.outbox.put_nowait((tx, event_id))
+            elif relay.connected:
+                full.append(relay)
+            else:
+                # a relay that is down does not hold back the others
+                relay.dropped += 1
+                if event_id:
+                    relay.pending_publishes.pop(event_id, None)
+        for relay in full:
+            await relay.outbox.put((tx, event_id))
+
+    async def _publish(self, event: dict, relays: list[RelayConnection] | None = None):
+        """
+        Publishes a signed event to the relays, and tracks it until each relay
+        acknowledges it.
+
+        Args:
+            event (Dict): The event to be published.
+            relays (List[RelayConnection]): The relays (all if None)
+        """
+        for relay in relays or self.relays:
+            relay.pending_publishes[event["id"]] = PendingPublish()
+        await self._send(["EVENT", event], relays)
+
+    def _on_frame_sent(self, relay: RelayConnection, event_id: str | None):
+        """
+        Start waiting for the acknowledgment of a sent event.
+        """
+        pending = relay.pending_publishes.get(event_id) if event_id else None
+        if pending:
+            # wait longer after each attempt, like the rejected events
+            timeout = self.publish_ack_timeout * 2 ** (pending.attempts - 1)
+            pending.next_retry_at = time.monotonic() + timeout
+
+    async def _on_ok_message(self, relay: RelayConnection, msg):
+        """
+        Handle the relay acknowledgment of a published event.
+        """
+        relay.sends_ok = True
+        event_id = msg[1]
+        pending = relay.pending_publishes.get(event_id)
+        if not pending:
+            return
+        accepted = msg[2] if len(msg) > 2 else False
+        info = str(msg[3]) if len(msg) > 3 else ""
+        if accepted or info.startswith("duplicate:"):
+            del relay.pending_publishes[event_id]
+            stats = self.publish_stats
+            latency = (time.monotonic() - pending.published_at) * 1000
+            stats["acked"] += 1
+            stats["ack_latency_avg_ms"] += (
+                latency - stats["ack_latency_avg_ms"]
+            ) / stats["acked"]
+            stats["ack_latency_max_ms"] = max(stats["ack_latency_max_ms"], latency)
+            return
+        self.publish_stats["rejected"] += 1
+        logger.warning(
+            "Event " + event_id + " rejected by the relay " + relay.url + ": " + info
+        )
+        if info.startswith(("rate-limited:", "error:")) or not info:
+            # temporary failure, retry with backoff
+            pending.next_retry_at = time.monotonic() + 2**pending.attempts
+        else:
+            # the relay will never accept this event
+            del relay.pending_publishes[event_id]
+            self.publish_stats["failed"] += 1
+
+    async def _publish_retry_loop(self):
+        """
+        Republish the events that were rejected or not acknowledged in time.
+        """
+        while not self._is_shutting_down():
+            await asyncio.sleep(1)
+            for relay in self.relays:
+                self._retry_publishes(relay)
+
+    def _retry_publishes(self, relay: RelayConnection):
+        now = time.monotonic()
+        for event_id, pending in list(relay.pending_publishes.items()):
+            if pending.next_retry_at is None or pending.next_retry_at > now:
+                continue
+            if not relay.sends_ok or pending.attempts >= self.publish_max_attempts:
+                del relay.pending_publishes[event_id]
+                if relay.sends_ok:
+                    logger.warning(
+                        "Giving up publishing event " + event_id + " to " + relay.url
+                    )
+                    self.publish_stats["failed"] += 1
+                continue
+            if relay.outbox.full():
+                break
+            pending.attempts += 1
+            pending.next_retry_at = None
+            self.publish_stats["retried"] += 1
+            relay.outbox.put_nowait((pending.frame, event_id))
+
+    async def _send_now(self, relay: RelayConnection, data: list[Any]):
+        """
+        Sends data bound to the current connection (eg. subscriptions)
+        directly to a relay.
+
+        Args:
+            relay (RelayConnection): The relay.
+            data (Dict): The data to be sent.
+        """
+        if not relay.ws:
+            raise Exception("Websocket connection is not established")
+        tx = self._json_dumps(data)
+        await relay.ws.send(tx)
+
+    def get_outbound_queue_size(self) -> int:
+        """
+        Returns the number of frames waiting to be sent to any of the relays.
+        """
+        return sum(relay.get_outbound_queue_size() for relay in self.relays)
+
+    async def _writer_loop(self, relay: RelayConnection, max_batch_size: int = 100):
+        """
+        Send the queued frames to a relay, in batches.
+        """
+        while not self._is_shutting_down():
+            if not relay.unsent:
+                relay.unsent.append(await relay.outbox.get())
+            while len(relay.unsent) < max_batch_size and not relay.outbox.empty():
+                relay.unsent.append(relay.outbox.get_nowait())
+            await self._wait_for_connection(relay)
+            ws = relay.ws
+            if not ws:
+                continue
+            try:
+                while relay.unsent:
+                    frame, event_id = relay.unsent[0]
+                    await ws.send(frame)
+                    relay.unsent.popleft()
+                    self._on_frame_sent(relay, event_id)
+            except Exception as e:
+                # keep the unsent frames until the connection is back
+                logger.debug("Error sending message to " + relay.url + ": " + str(e))
+                if ws is relay.ws:
+                    relay.connected = False
+                await asyncio.sleep(1)
 
     def _get_new_subid(self) -> str:
         """
@@ -243,20 +1224,36 @@ class NWCServiceProvider:
                 subid += chars[random.randint(0, len(chars) - 1)]
         return subid
 
-    async def _wait_for_connection(self):
+    @property
+    def connected(self) -> bool:
+        """
+        True if at least one of the relays is connected.
+        """
+        return any(relay.connected for relay in self.relays)
+
+    async def _wait_for_connection(
+        self, relay: RelayConnection, shutdown_check_interval: float = 5
+    ):
         """
-        Waits until the connection is established.
+        Waits until the connection to a relay is established.
+        The waiters are woken up as soon as the connection becomes ready,
+        the timeout is only used to notice a shutdown.
         """
-        while not self.connected:
+        while not relay.connected:
             if self._is_shutting_down():
                 raise Exception("Connection is closing")
-            logger.debug("Waiting for connection...")
-            await asyncio.sleep(1)
+            logger.debug("Waiting for connection to " + relay.url + "...")
+            try:
+                await asyncio.wait_for(relay.ready.wait(), shutdown_check_interval)
+            except asyncio.TimeoutError:
+                pass
 
-    async def _ratelimit(self, unit: str, max_sleep_time: int = 120) -> None:
-        limit: RateLimit | None = self.rate_limit.get(unit)
+    async def _ratelimit(
+        self, relay: RelayConnection, unit: str, max_sleep_time: int = 120
+    ) -> None:
+        limit: RateLimit | None = relay.rate_limit.get(unit)
         if not limit:
-            self.rate_limit[unit] = limit = RateLimit()
+            relay.rate_limit[unit] = limit = RateLimit()
 
         if time.time() - limit.last_attempt_time > max_sleep_time:
             # reset backoff if action lasted more than max_sleep_time
@@ -270,52 +1267,127 @@ class NWCServiceProvider:
         await asyncio.sleep(limit.backoff)
         limit.last_attempt_time = int(time.time())
 
-    async def _subscribe(self):
+    async def _subscribe(self, relay: RelayConnection):
         """
-        [Re]Subscribe to receive nip 47 requests and responses from the relay
+        [Re]Subscribe to receive nip 47 requests and responses from a relay
         """
-        self.sub = MainSubscription()
         # Create requests subscription
+        requests_since = self._get_since(self.checkpoints["requests"])
         req_filter = {
             "kinds": [23194],
             "#p": [self.public_key_hex],
-            # Since the last handle_missed_events seconds (handles reboots)
-            "since": int(time.time()) - self.handle_missed_events,
+            # Since the last checkpoint, but not before the last
+            # handle_missed_events seconds (handles reboots)
+            "since": requests_since,
         }
-        self.sub.requests_sub_id = self._get_new_subid()
         # Create responses subscription (needed to track previosly responded requests)
+        # Note: the responses to the requests after the checkpoint can be older
+        #       than the newest response
         res_filter = {
             "kinds": [23195],
             "authors": [self.public_key_hex],
-            "since": int(time.time()) - self.handle_missed_events,
+            "since": min(
+                requests_since, self._get_since(self.checkpoints["responses"])
+            ),
         }
-        self.sub.responses_sub_id = self._get_new_subid()
+        sub = MainSubscription(
+            Subscription(self._get_new_subid(), req_filter),
+            (
+                Subscription(self._get_new_subid(), res_filter)
+                if self.subscribe_responses
+                else None
+            ),
+        )
+        relay.sub = sub
         # Subscribe
-        await self._send(["REQ", self.sub.requests_sub_id, req_filter])
-        await self._send(["REQ", self.sub.responses_sub_id, res_filter])
+        for s in sub.get_all():
+            await self._send_now(relay, ["REQ", s.sub_id, s.filters])
+
+    def _get_since(self, checkpoint: int) -> int:
+        """
+        Returns the since filter to fetch the events missed after a checkpoint
+        """
+        since = int(time.time()) - self.handle_missed_events
+        if checkpoint > 0:
+            since = max(since, checkpoint - self.checkpoint_skew)
+        return since
+
+    def _is_caught_up(self) -> bool:
+        """
+        Returns True if the stored events were received from all the relays.
+        """
+        subs = [relay.sub for relay in self.relays if relay.sub]
+        return bool(subs) and all(sub.is_caught_up() for sub in subs)
+
+    def _update_checkpoints(self):
+        """
+        Move the checkpoints forward (or back, if older requests are pending)
+        """
+        # relays usually send the stored events newest first, the older
+        # events may still be on their way until the eose
+        if not self._is_caught_up():
+            return
+        checkpoint = self.requests.get_checkpoint()
+        if checkpoint > 0:
+            self.checkpoints["requests"] = checkpoint
+        if self.newest_response > self.checkpoints["responses"]:
+            self.checkpoints["responses"] = self.newest_response
 
-    async def _on_connection(self, _):
+    async def _save_checkpoints(self):
+        """
+        Pass the checkpoints to the listener, if they changed
+        """
+        self._update_checkpoints()
+        if not self.checkpoint_listener or self.checkpoints == self.saved_checkpoints:
+            return
+        checkpoints = dict(self.checkpoints)
+        try:
+            await self.checkpoint_listener(checkpoints)
+            self.saved_checkpoints = checkpoints
+        except Exception as e:
+            logger.warning("Error saving checkpoints: " + str(e))
+
+    async def _checkpoint_loop(self, interval: float = 10):
+        while not self._is_shutting_down():
+            await asyncio.sleep(interval)
+            await self._save_checkpoints()
+
+    def _on_response(self, event: dict):
+        """
+        Track the newest response (published or received)
+        """
+        created_at = min(event["created_at"], int(time.time()))
+        self.newest_response = max(self.newest_response, created_at)
+
+    async def _on_connection(self, relay: RelayConnection):
         """
         On connection callback, announce the service provider
         methods and subscribe to nip67 events.
         """
         # Send info event
-        await self._send_info_event()
+        await self._send_info_event([relay])
         # Resubscribe to nwc events
-        await self._subscribe()
+        await self._subscribe(relay)
 
-    async def _send_info_event(self):
+    async def _send_info_event(self, relays: list[RelayConnection] | None = None):
         """
         Build and publish the NWC service info event (kind 13194).
+
+        Args:
+            relays (List[RelayConnection]): The relays (all if None)
         """
         event = {
             "kind": 13194,
             "content": " ".join(self.supported_methods),
             "created_at": int(time.time()),
-            "tags": [["p", self.public_key_hex]],
+            "tags": [
+                ["p", self.public_key_hex],
+                ["encryption", " ".join(SUPPORTED_ENCRYPTIONS)],
+            ],
         }
+        self._add_expiration(event, self.info_event_ttl)
         self._sign_event(event)
-        await self._send(["EVENT", event])
+        await self._publish(event, relays)
 
     async def _info_event_loop(self):
         """
@@ -325,22 +1397,87 @@ class NWCServiceProvider:
         """
         while not self._is_shutting_down():
             await asyncio.sleep(60)
-            if self.connected and not self._is_shutting_down():
+            relays = [relay for relay in self.relays if relay.connected]
+            if relays and not self._is_shutting_down():
                 try:
-                    await self._send_info_event()
+                    await self._send_info_event(relays)
                 except Exception as e:
                     logger.warning("Error resending info event: " + str(e))
 
+    def _get_shared_secret(self, pubkey: str) -> bytes:
+        """
+        Returns the ECDH shared secret with a client, computing it only
+        if it is not cached.
+        """
+        shared_secret = self.shared_secrets.get(pubkey)
+        if shared_secret is None:
+            shared_secret = nip04.compute_shared_secret(self.private_key_bytes, pubkey)
+            self.shared_secrets.set(pubkey, shared_secret)
+        return shared_secret
+
+    def _get_conversation_key(self, pubkey: str) -> bytes:
+        """
+        Returns the nip44 conversation key with a client, deriving it only
+        if it is not cached.
+        """
+        conversation_key = self.conversation_keys.get(pubkey)
+        if conversation_key is None:
+            conversation_key = nip44.conversation_key_from_shared_secret(
+                self._get_shared_secret(pubkey)
+            )
+            self.conversation_keys.set(pubkey, conversation_key)
+        return conversation_key
+
+    def _get_encryption(self, event: dict) -> str:
+        """
+        Returns the encryption scheme used by a request
+        """
+        for tag in event["tags"]:
+            if len(tag) > 1 and tag[0] == "encryption":
+                schemes = tag[1].split(" ")
+                for scheme in SUPPORTED_ENCRYPTIONS:
+                    if scheme in schemes:
+                        return scheme
+        # requests without the encryption tag are nip04, unless
+        # the content is clearly not a nip04 payload
+        if "?iv=" not in event["content"]:
+            return "nip44_v2"
+        return "nip04"
+
+    def _encrypt(self, content: str, pubkey: str, encryption: str = "nip04") -> str:
+        """
+        Encrypts the content of an event for a client
+        """
+        if encryption == "nip44_v2":
+            return nip44.encrypt(self._get_conversation_key(pubkey), content)
+        return nip04.encrypt(self._get_shared_secret(pubkey), content)
+
+    def _decrypt(self, content: str, pubkey: str, encryption: str = "nip04") -> str:
+        """
+        Decrypts the content of an event from a client
+        """
+        if encryption == "nip44_v2":
+            return nip44.decrypt(self._get_conversation_key(pubkey), content)
+        return nip04.decrypt(self._get_shared_secret(pubkey), content)
+
+    def forget_client(self, pubkey: str):
+        """
+        Purges all the cached data of a client (eg. when its key is deleted).
+        """
+        self.shared_secrets.remove(pubkey)
+        self.conversation_keys.remove(pubkey)
+
     async def _handle_request(self, event: dict) -> list[dict]:
         """
         Handle a nwc request
         """
         nwc_pubkey = event["pubkey"]
         content = event["content"]
-        # Decrypt the content
-        content = self.private_key.decrypt_message(content, nwc_pubkey)
+        # Decrypt the content (responses use the same encryption)
+        encryption = self._get_encryption(event)
+        content = self._decrypt(content, nwc_pubkey, encryption)
         # Deserialize content
-        content = json.loads(content)
+        content = json_codec.loads(content)
         # Handle request
         method = content["method"]
         listener = self.request_listeners.get(method, None)
@@ -389,21 +1526,93 @@ class NWCServiceProvider:
             res["tags"].append(["e", event["id"]])
             # Reference user
             res["tags"].append(["p", nwc_pubkey])
+            # Let the relays drop the response when it is no longer needed
+            self._add_expiration(res, self.response_ttl)
             # Finalize response event
-            res["content"] = self.private_key.encrypt_message(
-                res["content"], nwc_pubkey
-            )
+            res["content"] = self._encrypt(res["content"], nwc_pubkey, encryption)
             self._sign_event(res)
 
             # Register response for this request, so we knows it is not stale
-            if self.sub:
-                self.sub.register_response(event["id"])
+            self.requests.mark_responded(event["id"])
+            self._on_response(res)
             # Send response event
-            await self._send(["EVENT", res])
+            await self._publish(res)
             # Track sent events
             sent_events.append(res)
         return sent_events
 
+    async def _process_request(self, event: dict):
+        """
+        Handle a request dispatched to the workers
+        """
+        deadline = self._get_deadline(event)
+        token = request_deadline.set(deadline)
+        try:
+            if not self.requests.is_pending(event["id"]):
+                # a response was received while the request was queued
+                return
+            if deadline and deadline <= time.time():
+                # the client gave up while the request was queued
+                self.expired_requests += 1
+                logger.warning("Dropping expired request " + event["id"])
+                return
+            if not await self._append_to_journal(event):
+                # fail closed, a request that is not in the journal
+                # could be handled again after a restart
+                logger.error("Dropping request " + event["id"] + " not journaled")
+                return
+            await self._handle_request(event)
+        finally:
+            request_deadline.reset(token)
+            # the full payload is not needed anymore
+            self.requests.mark_processed(event["id"])
+
+    def _get_deadline(self, event: dict) -> float | None:
+        """
+        Returns the time after which a request should not be handled anymore,
+        or None if it never expires.
+        """
+        deadlines = []
+        expiration = self._extract_expiration_from_tags(event["tags"])
+        if expiration > 0:
+            deadlines.append(expiration)
+        if self.max_request_age > 0:
+            deadlines.append(event["created_at"] + self.max_request_age)
+        return min(deadlines) if deadlines else None
+
+    async def _append_to_journal(self, event: dict) -> bool:
+        """
+        Record a request as handled before handling it, so that it is never
+        handled twice (eg. after a restart in the middle of a payment)
+
+        Returns:
+            bool: False if the request could not be recorded
+        """
+        if not self.journal_append:
+            return True
+        try:
+            created_at = min(event["created_at"], int(time.time()))
+            await self.journal_append(event["id"], created_at)
+        except Exception as e:
+            logger.error("Error writing the journal: " + str(e))
+            return False
+        return True
+
+    def _add_expiration(self, event: dict, ttl: int):
+        """
+        Add a nip 40 expiration tag to an unsigned event, unless
+        it already has one.
+
+        Args:
+            event (Dict): The event.
+            ttl (int): Seconds after created_at (0 to not expire)
+        """
+        if ttl <= 0:
+            return
+        if any(len(tag) > 1 and tag[0] == "expiration" for tag in event["tags"]):
+            return
+        event["tags"].append(["expiration", str(event["created_at"] + ttl)])
+
     def _extract_expiration_from_tags(self, tags: list) -> int:
         expiration = -1
         for tag in tags:
@@ -415,72 +1624,154 @@ class NWCServiceProvider:
                 pass
         return expiration
 
-    async def _on_event_message(self, msg):
-        if not self.sub:
-            return
-        sub_id = msg[1]
-        event = msg[2]
-        # Ensure the event is valid (do not trust relays)
-        if not self._verify_event(event):
-            raise Exception("Invalid event signature")
+    def _check_event_structure(self, event: Any) -> bool:
+        """
+        Cheap sanity checks on the shape and size of an event.
+        """
+        if not isinstance(event, dict):
+            return False
+        for field, field_type in EVENT_FIELDS.items():
+            if not isinstance(event.get(field), field_type):
+                return False
+        if (
+            len(event["id"]) != 64
+            or len(event["pubkey"]) != 64
+            or len(event["sig"]) != 128
+            or len(event["content"]) > MAX_EVENT_CONTENT_SIZE
+            or len(event["tags"]) > MAX_EVENT_TAGS
+        ):
+            return False
+        for tag in event["tags"]:
+            if not isinstance(tag, list) or not all(isinstance(v, str) for v in tag):
+                return False
+        return True
+
+    def _validate_event(
+        self, sub: MainSubscription, sub_id: Any, event: Any
+    ) -> str | None:
+        """
+        Validate an incoming event, running the cheapest checks first
+        so that junk is rejected before paying for the crypto.
+
+        Args:
+            sub (MainSubscription): The subscription of the relay.
+            sub_id (str): The subscription id the event was received for.
+            event (Dict): The event to validate.
+
+        Returns:
+            str | None: The stage that rejected the event, or None if valid.
+        """
+        # 1. structure and size
+        if not self._check_event_structure(event):
+            return "structure"
+        kind = event["kind"]
         tags = event["tags"]
+        # 2. kind and subscription routing
+        if kind == 23194 and sub_id == sub.requests.sub_id:
+            # 3. ensure the request is for this service provider
+            if not any(
+                len(tag) > 1 and tag[0] == "p" and tag[1] == self.public_key_hex
+                for tag in tags
+            ):
+                return "author"
+            # ensure the request is from a known client
+            if self.client_filter and not self.client_filter(event["pubkey"]):
+                return "client"
+        elif kind == 23195 and sub.responses and sub_id == sub.responses.sub_id:
+            # 3. ensure the response is from this service provider
+            if event["pubkey"] != self.public_key_hex:
+                return "author"
+        else:
+            return "routing"
+        # 4. handle event expiration if the relay doesn't support nip 40
         expiration = self._extract_expiration_from_tags(tags)
-        # Handle event expiration if the relay doesn't support nip 40
         if expiration > 0 and expiration < int(time.time()):
-            logger.debug("Event expired")
+            return "expired"
+        # 5. and 6. ensure the event id and signature are valid (do not trust relays)
+        return self._check_event_crypto(event)
+
+    async def _on_event_message(self, relay: RelayConnection, msg):
+        sub = relay.sub
+        if not sub:
             return
-        if event["kind"] == 23194 and sub_id == self.sub.requests_sub_id:
-            # Ensure the request is for this service provider
-            valid_p = any(
-                tag[0] == "p" and tag[1] == self.public_key_hex for tag in tags
-            )
-            if not valid_p:
-                raise Exception("Unexpected request from another service")
-            # Track request
-            self.sub.events[event["id"]] = event
-            # if eose was received for both subscriptions, we handle the request
-            # in realtime if not, we do nothing since the request may be
-            # already handled or stale, all stale requests will be handled
-            # later when eose is received
-            if self.sub.requests_eose and self.sub.responses_eose:
-                await self._handle_request(event)
-        elif event["kind"] == 23195 and sub_id == self.sub.responses_sub_id:
-            # Ensure the response is from this service provider
-            if event["pubkey"] != self.public_key_hex:
-                raise Exception("Unexpected response from another service")
+        sub_id = msg[1]
+        event = msg[2] if len(msg) > 2 else None
+        rejected = self._validate_event(sub, sub_id, event)
+        if rejected:
+            self.rejected_events[rejected] = self.rejected_events.get(rejected, 0) + 1
+            logger.debug("Rejected event at stage " + rejected)
+            return
+        if event["kind"] == 23194:
+            sub.requests.on_event(event["created_at"])
+            # Track request (the same request can be received from
+            # multiple relays, only the first copy is tracked)
+            self.requests.add(event)
+            # if eose was received for both subscriptions (and for the
+            # responses of the other relays), we handle the request in realtime
+            # if not, we do nothing since the request may be already handled
+            # or stale, all stale requests will be handled later when eose
+            # is received
+            sub.catchup_ids.append(event["id"])
+            self._dispatch_catchup()
+        elif sub.responses:
+            sub.responses.on_event(event["created_at"])
+            self._on_response(event)
             # Register as response for each e tag (request event id)
             # Note: usually we expect only one "e" tag, but we are handling
             # multiple "e" tags just in case
-            etag = next((tag[1] for tag in tags if tag[0] == "e"), None)
+            etag = next(
+                (tag[1] for tag in event["tags"] if len(tag) > 1 and tag[0] == "e"),
+                None,
+            )
             if etag:
-                self.sub.register_response(etag)
+                self.requests.mark_responded(etag)
 
-    async def _on_eose_message(self, msg):
-        if not self.sub:
+    async def _on_eose_message(self, relay: RelayConnection, msg):
+        sub = relay.sub
+        if not sub:
             return
         sub_id = msg[1]
         # Track EOSE
-        if sub_id == self.sub.requests_sub_id:
-            self.sub.requests_eose = True
-        elif sub_id == self.sub.responses_sub_id:
-            self.sub.responses_eose = True
-        # When both EOSE are receives, handle all the stale requests
-        #   Note: All the requests that were received prior to the
-        #         service connection and do not have a response yet,
-        #         are considered stale, we will process them now
-        if self.sub.requests_eose and self.sub.responses_eose:
-            stales = self.sub.get_stale()
-            for stale in stales:
-                await self._handle_request(stale)
-
-    async def _on_closed_message(self, msg):
-        if not self.sub:
+        eose_sub = sub.get(sub_id)
+        if eose_sub:
+            eose_sub.eose = True
+        self._dispatch_catchup()
+
+    def _dispatch_catchup(self):
+        """
+        Handle the stale requests once the stored responses were received
+        from all the connected relays.
+          Note: All the requests that were received prior to the
+                service connection and do not have a response yet,
+                are considered stale, we will process them now
+        """
+        for relay in self.relays:
+            sub = relay.sub
+            if not relay.connected or not sub or not sub.responses:
+                continue
+            if not sub.responses.eose:
+                # the response to a request could still be on its way
+                return
+        for relay in self.relays:
+            sub = relay.sub
+            if not sub or not sub.is_caught_up():
+                continue
+            catchup_ids, sub.catchup_ids = sub.catchup_ids, []
+            for event_id in catchup_ids:
+                stale = self.requests.get_payload(event_id)
+                if stale:
+                    self.dispatcher.dispatch(stale)
+
+    async def _on_closed_message(self, relay: RelayConnection, msg):
+        sub = relay.sub
+        if not sub:
             return
         # Subscription was closed remotely.
         sub_id = msg[1]
         info = msg[2] or "" if len(msg) > 2 else ""
         # Resubscribe if one of the main subscriptions was closed
-        if sub_id == self.sub.requests_sub_id or sub_id == self.sub.responses_sub_id:
+        closed = sub.get(sub_id)
+        if closed:
             logger.warning(
                 "Subscription "
                 + sub_id
@@ -488,69 +1779,127 @@ class NWCServiceProvider:
                 + info
                 + " ... resubscribing..."
             )
-            await self._ratelimit("subscribing")
-            await self._subscribe()
+            await self._ratelimit(relay, "subscribing")
+            if relay.sub is not sub:
+                # the relay was reconnected in the meantime
+                return
+            # resume only the closed subscription, from the last seen event,
+            # the tracked requests and the eose state are kept
+            await self._send_now(
+                relay, ["REQ", closed.sub_id, closed.get_resume_filters()]
+            )
 
-    async def _on_message(self, _, message: str):
+    async def _on_message(self, relay: RelayConnection, message: str):
         """
-        Handle incoming messages from the relay.
+        Handle incoming messages from a relay.
         """
         try:
-            msg = json.loads(message)
+            msg = json_codec.loads(message)
             if msg[0] == "EVENT":  # Event message
-                await self._on_event_message(msg)
+                await self._on_event_message(relay, msg)
             elif msg[0] == "EOSE":
-                await self._on_eose_message(msg)
+                await self._on_eose_message(relay, msg)
             elif msg[0] == "CLOSED":
-                await self._on_closed_message(msg)
+                await self._on_closed_message(relay, msg)
             elif msg[0] == "NOTICE":
                 # A message from the relay, mostly useless, but we log it anyway
-                logger.info("Notice from relay " + self.relay + ": " + str(msg[1]))
+                logger.info("Notice from relay " + relay.url + ": " + str(msg[1]))
             elif msg[0] == "OK":
-                pass
+                await self._on_ok_message(relay, msg)
             else:
                 raise Exception("Unknown message type " + str(msg[0]))
         except Exception as e:
             logger.error("Error parsing event: " + str(e))
 
-    async def _connect_to_relay(self):
+    async def _connect_to_relay(self, relay: RelayConnection):
         """
-        Initiate websocket connection to the relay.
+        Initiate websocket connection to a relay.
         """
-        await asyncio.sleep(1)
-        logger.debug("Connecting to NWC relay " + self.relay)
+        logger.debug("Connecting to NWC relay " + relay.url)
         while (
             not self._is_shutting_down()
         ):  # Reconnect until the instance is shutting down
-            logger.debug("Creating new connection...")
-            try:
-                async with connect(self.relay) as ws:
-                    self.ws = ws
-                    self.connected = True
-                    await self._on_connection(ws)
-                    while (
-                        not self._is_shutting_down()
-                    ):  # receive messages until the instance is shutting down
-                        try:
-                            reply = await ws.recv()
-                            if isinstance(reply, bytes):
-                                reply = reply.decode("utf-8")
-                            await self._on_message(ws, reply)
-                        except Exception as e:
-                            logger.debug("Error receiving message: " + str(e))
-                            break
-                logger.debug("Connection to NWC relay closed")
-            except Exception as e:
-                logger.error("Error connecting to NWC relay: " + str(e))
-                await asyncio.sleep(5)
+            clean_close = await self._run_connection(relay)
             # the connection was closed, so we set the connected flag to False
             # this will make the methods calling _wait_for_connection() to wait
             # until the connection is re-established
-            self.connected = False
+            relay.connected = False
+            # the relay does not hold back the stale requests anymore
+            self._dispatch_catchup()
             if not self._is_shutting_down():
-                # Wait some time before reconnecting
-                logger.debug("Reconnecting to NWC relay...")
-                await self._ratelimit("connecting")
+                delay = self.reconnect_policy.next_delay(relay.health, clean_close)
+                logger.debug(
+                    "Reconnecting to NWC relay "
+                    + relay.url
+                    + " in "
+                    + str(round(delay, 2))
+                    + "s..."
+                )
+                await asyncio.sleep(delay)
+
+    async def _run_connection(self, relay: RelayConnection) -> bool:
+        """
+        Connects to a relay and handles the messages until the
+        connection is closed.
+
+        Returns:
+            bool: True if a stable connection was closed
+        """
+        logger.debug("Creating new connection to " + relay.url + "...")
+        started_at = time.monotonic()
+        try:
+            # the websocket keepalive pings the relay and closes the connection
+            # if it stops answering (so that it is reconnected right away)
+            policy = self.reconnect_policy
+            async with connect(
+                relay.url,
+                ping_interval=policy.ping_interval or None,
+                ping_timeout=policy.ping_timeout or None,
+            ) as ws:
+                relay.health.on_connected(time.monotonic() - started_at)
+                relay.ws = ws
+                await self._on_connection(relay)
+                # ready only once the subscriptions are in place
+                relay.connected = True
+                latency_task = asyncio.create_task(self._latency_loop(relay, ws))
+                try:
+                    await self._receive_loop(relay, ws)
+                finally:
+                    latency_task.cancel()
+            logger.debug("Connection to NWC relay " + relay.url + " closed")
+        except Exception as e:
+            logger.error("Error connecting to NWC relay " + relay.url + ": " + str(e))
+            relay.health.on_failure()
+            return False
+        return relay.health.on_closed(self.reconnect_policy.stable_after)
+
+    async def _receive_loop(self, relay: RelayConnection, ws):
+        """
+        Receive messages until the connection is closed
+        or the instance is shutting down.
+        """
+        while not self._is_shutting_down():
+            try:
+                reply = await ws.recv()
+                if isinstance(reply, bytes):
+                    reply = reply.decode("utf-8")
+                await self._on_message(relay, reply)
+            except Exception as e:
+                logger.debug("Error receiving message: " + str(e))
+                break
+
+    async def _latency_loop(self, relay: RelayConnection, ws):
+        """
+        Records the round trip time of the keepalive pings in the
+        relay health.
+        """
+        interval = self.reconnect_policy.ping_interval
+        if interval <= 0:
+            return
+        while not self._is_shutting_down():
+            await asyncio.sleep(interval)
+            if ws.latency > 0:
+                relay.health.on_ping(ws.latency)
 
     def _verify_event(self, event: dict) -> bool:
         """
@@ -562,7 +1911,31 @@ class NWCServiceProvider:
         Returns:
             bool: True if the event signature is valid, False otherwise.
         """
-        signature_data = self._json_dumps(
+        return self._check_event_crypto(event) is None
+
+    def _check_event_crypto(self, event: dict) -> str | None:
+        """
+        Verify the event id and then the event signature
+
+        Args:
+            event (Dict): The event to verify.
+
+        Returns:
+            str | None: "id" or "signature" if the check failed, None if valid.
+        """
+        # Events are identified by their id, but a copy of an already verified
+        # event is trusted only if all its signed fields are the same
+        signed_fields = (
+            event["pubkey"],
+            event["created_at"],
+            event["kind"],
+            event["tags"],
+            event["content"],
+            event["sig"],
+        )
+        if self.verified_events.get(event["id"]) == signed_fields:
+            return None
+        signature_data = json_codec.dumps_bytes(
             [
                 0,
                 event["pubkey"],
@@ -572,14 +1945,18 @@ class NWCServiceProvider:
                 event["content"],
             ]
         )
-        event_id = hashlib.sha256(signature_data.encode()).hexdigest()
+        event_id = hashlib.sha256(signature_data).hexdigest()
         if event_id != event["id"]:  # Invalid event id
-            return False
-        pubkey_hex = event["pubkey"]
-        pubkey = PublicKeyXOnly(bytes.fromhex(pubkey_hex))
-        if not pubkey.verify(bytes.fromhex(event["sig"]), bytes.fromhex(event_id)):
-            return False
-        return True
+            return "id"
+        try:
+            pubkey = PublicKeyXOnly(bytes.fromhex(event["pubkey"]))
+            valid = pubkey.verify(bytes.fromhex(event["sig"]), bytes.fromhex(event_id))
+        except Exception:
+            valid = False
+        if not valid:
+            return "signature"
+        self.verified_events.set(event_id, signed_fields)
+        return None
 
     def _sign_event(self, event: dict) -> dict:
         """
@@ -591,7 +1968,7 @@ class NWCServiceProvider:
         Returns:
             Dict: The input event with the signature added.
         """
-        signature_data = self._json_dumps(
+        signature_data = json_codec.dumps_bytes(
             [
                 0,
                 self.public_key_hex,
@@ -602,7 +1979,7 @@ class NWCServiceProvider:
             ]
         )
 
-        event_id = hashlib.sha256(signature_data.encode()).hexdigest()
+        event_id = hashlib.sha256(signature_data).hexdigest()
         event["id"] = event_id
         event["pubkey"] = self.public_key_hex
 
@@ -614,27 +1991,33 @@ class NWCServiceProvider:
         logger.debug("Closing NWC Service Provider connection")
         self.shutdown = True  # Mark for shutdown
         # close tasks
+        tasks = {
+            "gc loop": self.gc_task,
+            "info event loop": self.info_event_task,
+            "publish retry loop": self.publish_retry_task,
+            "checkpoint loop": self.checkpoint_task,
+        }
+        for relay in self.relays:
+            for task in relay.tasks:
+                task.cancel()
+        for name, task in tasks.items():
+            try:
+                if task:
+                    task.cancel()
+            except Exception as e:
+                logger.warning("Error closing " + name + ": " + str(e))
         try:
-            if self.reconnect_task:
-                self.reconnect_task.cancel()
-        except Exception as e:
-            logger.warning("Error closing reconnection task: " + str(e))
-        try:
-            if self.gc_task:
-                self.gc_task.cancel()
-        except Exception as e:
-            logger.warning("Error closing gc loop: " + str(e))
-        try:
-            if self.info_event_task:
-                self.info_event_task.cancel()
-        except Exception as e:
-            logger.warning("Error closing info event loop: " + str(e))
-        # close the websocket
-        try:
-            if self.ws:
-                await self.ws.close()
+            self.dispatcher.stop()
         except Exception as e:
-            logger.warning("Error closing websocket connection: " + str(e))
+            logger.warning("Error closing request dispatcher: " + str(e))
+        # close the websockets
+        for relay in self.relays:
+            try:
+                if relay.ws:
+                    await relay.ws.close()
+            except Exception as e:
+                logger.warning("Error closing websocket connection: " + str(e))
+        await self._save_checkpoints()
 
     class Config:
         arbitrary_types_allowed = True
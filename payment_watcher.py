@@ -0,0 +1,166 @@
+import asyncio
+import time
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from loguru import logger
+
+
+class WatchedPayment:
+    """
+    A pending payment and the coroutines waiting for it.
+    """
+
+    def __init__(self, min_interval: float):
+        self.waiters: list[asyncio.Future] = []
+        self.registered_at = time.monotonic()
+        self.interval = min_interval
+        self.next_check_at = self.registered_at + min_interval
+
+
+class PaymentWatcher:
+    """
+    Wait for the outgoing payments to settle, with a single shared poller
+    instead of a polling loop for each payment.
+    The due payments are checked in batches, and each payment is checked
+    less often the longer it stays pending (exponential backoff), so that
+    long pending payments (eg. hold invoices) do not keep hammering
+    the funding source.
+    """
+
+    def __init__(
+        self,
+        check_status: Callable[[str, str], Awaitable[Any]],
+        min_interval: float = 0.05,
+        max_interval: float = 5,
+        max_batch_size: int = 20,
+    ):
+        """
+        Args:
+            check_status (Callable): Returns the status of a payment given
+                                     the wallet id and the payment hash.
+            min_interval (float): Seconds before the first check.
+            max_interval (float): Maximum seconds between two checks
+                                  of the same payment.
+            max_batch_size (int): Maximum number of concurrent checks.
+        """
+        self.check_status = check_status
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_batch_size = max(1, max_batch_size)
+        # Watched payments by (wallet_id, payment_hash)
+        self.payments: dict[tuple[str, str], WatchedPayment] = {}
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.stats: dict[str, Any] = {
+            "checks": 0,
+            "settled": 0,
+            "timed_out": 0,
+            "settle_latency_avg_ms": 0.0,
+            "settle_latency_max_ms": 0.0,
+        }
+
+    async def wait(self, wallet_id: str, payment_hash: str, timeout: float) -> Any:
+        """
+        Wait until a payment succeeds or fails.
+
+        Args:
+            wallet_id (str): The wallet that sent the payment.
+            payment_hash (str): The payment hash.
+            timeout (float): Maximum seconds to wait.
+
+        Returns:
+            PaymentStatus: The final status of the payment.
+
+        Raises:
+            asyncio.TimeoutError: If the payment is still pending after timeout.
+        """
+        key = (wallet_id, payment_hash)
+        payment = self.payments.get(key)
+        if not payment:
+            payment = self.payments[key] = WatchedPayment(self.min_interval)
+            self.wakeup.set()
+        future = asyncio.get_running_loop().create_future()
+        payment.waiters.append(future)
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self._poll_loop())
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.stats["timed_out"] += 1
+            raise
+        finally:
+            if future in payment.waiters:
+                payment.waiters.remove(future)
+                if not payment.waiters and self.payments.get(key) is payment:
+                    del self.payments[key]
+
+    def resolve(self, wallet_id: str, payment_hash: str, status: Any):
+        """
+        Wake up the waiters of a settled payment.
+        """
+        payment = self.payments.pop((wallet_id, payment_hash), None)
+        if not payment:
+            return
+        stats = self.stats
+        latency = (time.monotonic() - payment.registered_at) * 1000
+        stats["settled"] += 1
+        stats["settle_latency_avg_ms"] += (
+            latency - stats["settle_latency_avg_ms"]
+        ) / stats["settled"]
+        stats["settle_latency_max_ms"] = max(stats["settle_latency_max_ms"], latency)
+        for future in payment.waiters:
+            if not future.done():
+                future.set_result(status)
+
+    def get_stats(self) -> dict[str, Any]:
+        """
+        Returns the statistics of the watched payments.
+        """
+        return {
+            **self.stats,
+            "in_flight": len(self.payments),
+            "waiters": sum(len(p.waiters) for p in self.payments.values()),
+        }
+
+    def stop(self):
+        """
+        Stop the poller, the pending waiters time out.
+        """
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def _check(self, key: tuple[str, str], payment: WatchedPayment):
+        self.stats["checks"] += 1
+        try:
+            status = await self.check_status(*key)
+        except Exception as e:
+            logger.warning("Error checking payment status: " + str(e))
+            status = None
+        if status is not None and (status.success or status.failed):
+            self.resolve(*key, status)
+            return
+        # check again later
+        payment.interval = min(payment.interval * 2, self.max_interval)
+        payment.next_check_at = time.monotonic() + payment.interval
+
+    async def _poll_loop(self):
+        while self.payments:
+            self.wakeup.clear()
+            now = time.monotonic()
+            due = sorted(
+                (p.next_check_at, key)
+                for key, p in self.payments.items()
+                if p.next_check_at <= now
+            )
+            batch = [(key, self.payments[key]) for _, key in due[: self.max_batch_size]]
+            if batch:
+                await asyncio.gather(*(self._check(key, p) for key, p in batch))
+                # the other due payments are checked right away
+                continue
+            delay = min(p.next_check_at for p in self.payments.values()) - now
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
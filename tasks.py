@@ -14,13 +14,25 @@ from lnbits.core.services import (
 from lnbits.db import Filters
 from lnbits.exceptions import PaymentError
 from lnbits.settings import settings
-from lnbits.wallets.base import PaymentStatus
+from lnbits.wallets.base import PaymentStatus, PaymentSuccessStatus
 from loguru import logger
 
-from .crud import get_config_nwc, get_nwc, tracked_spend_nwc
-from .execution_queue import execution_queue
+from .crud import (
+    create_handled_nwc,
+    delete_handled_nwc,
+    get_checkpoints_nwc,
+    get_config_nwc,
+    get_handled_nwc,
+    get_nwc,
+    is_registered_pubkey,
+    load_registered_pubkeys,
+    nwc_delete_listeners,
+    set_checkpoints_nwc,
+    tracked_spend_nwc,
+)
+from .execution_queue import ExpiredActionError, execution_queue
 from .models import GetNWC, NWCKey, TrackedSpendNWC
-from .nwcp import NWCServiceProvider
+from .nwcp import NWCServiceProvider, ReconnectPolicy, get_request_deadline
 from .paranoia import (
     assert_boolean,
     assert_sane_string,
@@ -32,8 +44,37 @@ from .paranoia import (
     assert_valid_sha256,
     assert_valid_wallet_id,
 )
+from .payment_watcher import PaymentWatcher
 from .permission import nwc_permissions
 
+# The running service provider
+nwc_service_provider: NWCServiceProvider | None = None
+
+
+async def _check_payment_status(wallet_id: str, payment_hash: str) -> PaymentStatus:
+    return await check_transaction_status(wallet_id, payment_hash)
+
+
+# Shared poller of the pending outgoing payments
+payment_watcher = PaymentWatcher(_check_payment_status)
+# Seconds to wait for a pending payment before giving up
+payment_timeout: float = 60
+# Maximum number of invoices of a multi_pay_invoice request paid concurrently
+multi_pay_concurrency: int = 4
+
+
+def get_nwc_stats() -> dict[str, Any]:
+    """
+    Returns the runtime statistics of the running service provider.
+    """
+    if not nwc_service_provider:
+        return {}
+    return {
+        **nwc_service_provider.get_stats(),
+        "payments": payment_watcher.get_stats(),
+        "execution_queue": execution_queue.get_pending_count(),
+    }
+
 
 async def _check(nwc: NWCKey | None, method: str) -> dict | None:
     # check
@@ -76,6 +117,8 @@ async def _process_invoice(
         assert_sane_string(description)
     # ## #
 
+    payments: list[Payment] = []
+
     async def execute_payment() -> str:
         payment = await pay_invoice(
             wallet_id=wallet_id,
@@ -83,12 +126,16 @@ async def _process_invoice(
             max_sat=ceil(amount_msats / 1000),
             description=description or "",
         )
+        payments.append(payment)
         return payment.payment_hash
 
     payment_hash = None
     try:
         in_budget, payment_hash = await tracked_spend_nwc(
-            TrackedSpendNWC(pubkey=pubkey, amount_msats=amount_msats), execute_payment
+            TrackedSpendNWC(pubkey=pubkey, amount_msats=amount_msats),
+            execute_payment,
+            # do not pay if the client gave up while the payment was queued
+            deadline=get_request_deadline(),
         )
         if not in_budget:
             error = {
@@ -96,6 +143,12 @@ async def _process_invoice(
                 "message": "The wallet has exceeded its spending quota.",
             }
             return {"error": error, "in_budget": False}
+    except ExpiredActionError:
+        error = {
+            "code": "OTHER",
+            "message": "The request expired before the payment was sent.",
+        }
+        return {"error": error, "in_budget": False}
     except PaymentError as e:
         status = e.status
         message = e.message
@@ -106,25 +159,25 @@ async def _process_invoice(
             raise e
     if not payment_hash:
         raise Exception("Payment hash not found")
-    wait_for_preimage = (
-        True  # currently required by nip 47 specs, might change in future
+    payment_status = await _wait_for_payment(
+        wallet_id, payment_hash, payments[0] if payments else None
     )
-    payment_status: PaymentStatus | None = None
-    while wait_for_preimage:
-        payment_status = await check_transaction_status(wallet_id, payment_hash)
-        if payment_status.success:
-            break
-        if payment_status.failed:
-            return {
-                "error": {
-                    "code": "PAYMENT_FAILED",
-                    "message": "Payment failed.",
-                },
-                "in_budget": in_budget,
-            }
-        await asyncio.sleep(0.05)
     if not payment_status:
-        raise Exception("Payment status not found")
+        return {
+            "error": {
+                "code": "OTHER",
+                "message": "Payment timed out, it is still pending.",
+            },
+            "in_budget": in_budget,
+        }
+    if payment_status.failed:
+        return {
+            "error": {
+                "code": "PAYMENT_FAILED",
+                "message": "Payment failed.",
+            },
+            "in_budget": in_budget,
+        }
     return {
         "preimage": payment_status.preimage
         or "0000000000000000000000000000000000000000000000000000000000000000",
@@ -135,6 +188,35 @@ async def _process_invoice(
     }
 
 
+async def _wait_for_payment(
+    wallet_id: str, payment_hash: str, payment: Payment | None = None
+) -> PaymentStatus | None:
+    """
+    Wait until a payment succeeds or fails, the preimage is
+    currently required by nip 47 specs (might change in future)
+
+    Returns:
+        PaymentStatus | None: The final status, None if the payment
+                              is still pending after payment_timeout
+    """
+    # most payments are settled by the time pay_invoice returns
+    if payment and payment.success:
+        return PaymentSuccessStatus(fee_msat=payment.fee, preimage=payment.preimage)
+    payment_status = await check_transaction_status(wallet_id, payment_hash)
+    if payment_status.success or payment_status.failed:
+        return payment_status
+    # the others are checked by the shared poller
+    timeout = payment_timeout
+    deadline = get_request_deadline()
+    if deadline:
+        timeout = min(timeout, deadline - time.time())
+    try:
+        return await payment_watcher.wait(wallet_id, payment_hash, max(0, timeout))
+    except asyncio.TimeoutError:
+        logger.warning("Payment " + payment_hash + " is still pending")
+        return None
+
+
 async def _on_pay_invoice(
     sp: NWCServiceProvider, pubkey: str, payload: dict
 ) -> list[tuple[dict | None, dict | None, list]]:
@@ -176,6 +258,39 @@ async def _on_pay_invoice(
     return [(out, None, [])]
 
 
+async def _pay_multi_invoice(
+    wallet_id: str, pubkey: str, i: dict
+) -> tuple[dict | None, dict | None, list]:
+    """
+    Pay one of the invoices of a multi_pay_invoice request, the result
+    is tagged with the invoice id (or payment hash)
+    """
+    tags: list = []
+    try:
+        invoice_id = i.get("id", None)
+        invoice = i.get("invoice", None)
+        invoice_data = bolt11_decode(invoice)
+        amount_msats = int(invoice_data.amount_msat or 0)
+
+        # hardening #
+        assert_valid_bolt11(invoice)
+        assert_valid_msats(amount_msats)
+        if invoice_id:
+            assert_sane_string(invoice_id)
+        # ## #
+
+        tags = [["d", invoice_id if invoice_id else invoice_data.payment_hash]]
+        res = await _process_invoice(
+            wallet_id, pubkey, invoice, amount_msats, invoice_data.description
+        )
+        error = res.get("error")
+        if error:
+            return (None, error, tags)
+        return ({"preimage": res.get("preimage")}, None, tags)
+    except Exception as e:
+        return (None, {"code": "INTERNAL", "message": str(e)}, tags)
+
+
 async def _on_multi_pay_invoice(
     sp: NWCServiceProvider, pubkey: str, payload: dict
 ) -> list[tuple[dict | None, dict | None, list]]:
@@ -192,7 +307,6 @@ async def _on_multi_pay_invoice(
         raise Exception("Pubkey has no associated wallet")
     params = payload.get("params", {})
     invoices = params.get("invoices", [])
-    results: list[tuple[dict | None, dict | None, list]] = []
 
     # Ensures all invoices are provided
     for i in invoices:
@@ -200,37 +314,15 @@ async def _on_multi_pay_invoice(
         if not invoice:
             raise Exception("Missing invoice")
 
-    for i in invoices:
-        try:
-            invoice_id = i.get("id", None)
-            invoice = i.get("invoice", None)
-            invoice_data = bolt11_decode(invoice)
-            amount_msats = int(invoice_data.amount_msat or 0)
-
-            # hardening #
-            assert_valid_bolt11(invoice)
-            assert_valid_msats(amount_msats)
-            if invoice_id:
-                assert_sane_string(invoice_id)
-            # ## #
-
-            res = await _process_invoice(
-                nwc.wallet, pubkey, invoice, amount_msats, invoice_data.description
-            )
-            error = res.get("error")
-            if error:
-                results.append((None, error, []))
-            else:
-                r = (
-                    {
-                        "preimage": res.get("preimage"),
-                    },
-                    None,
-                    [["d", invoice_id if invoice_id else res.get("payment_hash")]],
-                )
-                results.append(r)
-        except Exception as e:
-            results.append((None, {"code": "INTERNAL", "message": str(e)}, []))
+    # pay the invoices concurrently, the budget is reserved for each payment
+    semaphore = asyncio.Semaphore(max(1, multi_pay_concurrency))
+    wallet_id = nwc.wallet
+
+    async def pay(i: dict) -> tuple[dict | None, dict | None, list]:
+        async with semaphore:
+            return await _pay_multi_invoice(wallet_id, pubkey, i)
+
+    results = list(await asyncio.gather(*(pay(i) for i in invoices)))
     # await log_nwc(pubkey, payload)
     return results
 
@@ -506,10 +598,54 @@ async def _on_get_info(
 
 
 async def handle_nwc():
+    global nwc_service_provider, payment_timeout, multi_pay_concurrency
     priv_key = await get_config_nwc("provider_key")
     relay = await get_config_nwc("relay")
     handle_missed_events = int(await get_config_nwc("handle_missed_events") or 0)
-    nwcsp = NWCServiceProvider(priv_key, relay, handle_missed_events)
+    max_concurrent_requests = int(await get_config_nwc("max_concurrent_requests") or 8)
+    max_tracked_requests = int(await get_config_nwc("max_tracked_requests") or 10000)
+    max_tracked_requests_per_client = int(
+        await get_config_nwc("max_tracked_requests_per_client") or 100
+    )
+    max_outbound_queue = int(await get_config_nwc("max_outbound_queue") or 1000)
+    reconnect_policy = ReconnectPolicy(
+        base_delay=float(await get_config_nwc("reconnect_base_delay") or 0.5),
+        max_delay=float(await get_config_nwc("reconnect_max_delay") or 60),
+        stable_after=float(await get_config_nwc("reconnect_stable_after") or 10),
+        ping_interval=float(await get_config_nwc("relay_ping_interval") or 30),
+    )
+    subscribe_responses = int(await get_config_nwc("subscribe_responses") or 0) > 0
+    # empty to derive the response ttl from handle_missed_events
+    response_ttl = await get_config_nwc("response_ttl")
+    info_event_ttl = int(await get_config_nwc("info_event_ttl") or 0)
+    max_request_age = int(await get_config_nwc("max_request_age") or 0)
+    payment_timeout = float(await get_config_nwc("payment_timeout") or 60)
+    multi_pay_concurrency = int(await get_config_nwc("multi_pay_concurrency") or 4)
+    # requests handled in the catch-up window (plus some margin)
+    handled_since = int(time.time()) - (handle_missed_events or 3600) - 60
+    # the journal replaces the past responses only once it covers
+    # the whole catch-up window (eg. not right after an upgrade)
+    journal_started_at = int(await get_config_nwc("journal_started_at") or 0)
+    if handle_missed_events > 0 and (
+        not journal_started_at or journal_started_at > handled_since
+    ):
+        subscribe_responses = True
+    nwcsp = NWCServiceProvider(
+        priv_key,
+        relay,
+        handle_missed_events,
+        max_concurrent_requests=max_concurrent_requests,
+        max_tracked_requests=max_tracked_requests,
+        max_tracked_requests_per_client=max_tracked_requests_per_client,
+        max_outbound_queue=max_outbound_queue,
+        reconnect_policy=reconnect_policy,
+        checkpoints=await get_checkpoints_nwc(),
+        handled_requests=await get_handled_nwc(max(0, handled_since)),
+        subscribe_responses=subscribe_responses,
+        response_ttl=int(response_ttl) if response_ttl else None,
+        info_event_ttl=info_event_ttl,
+        max_request_age=max_request_age,
+    )
     nwcsp.add_request_listener("pay_invoice", _on_pay_invoice)
     nwcsp.add_request_listener("multi_pay_invoice", _on_multi_pay_invoice)
     nwcsp.add_request_listener("make_invoice", _on_make_invoice)
@@ -521,29 +657,27 @@ async def handle_nwc():
     # nwcsp.addRequestListener("pay_keysend", _on_pay_keysend)
     # nwcsp.addRequestListener("multi_pay_keysend", _on_multi_pay_keysend)
     ###
+    await load_registered_pubkeys()
+    nwcsp.set_client_filter(is_registered_pubkey)
+    nwcsp.set_checkpoint_listener(set_checkpoints_nwc)
+    nwcsp.set_journal(create_handled_nwc, delete_handled_nwc)
+    nwc_delete_listeners.append(nwcsp.forget_client)
     await nwcsp.start()
+    nwc_service_provider = nwcsp
     try:
         while True:
             await asyncio.sleep(3600)
     except asyncio.CancelledError:
+        nwc_service_provider = None
+        nwc_delete_listeners.remove(nwcsp.forget_client)
+        payment_watcher.stop()
         await nwcsp.cleanup()
         raise
 
 
 async def handle_execution_queue():
-    while True:
-        try:
-            task = await execution_queue.get()
-            action = task.get("action")
-            future = task.get("future")
-            try:
-                if not action:
-                    raise Exception("Invalid action")
-                res = await action()
-                if future:
-                    future.set_result(res)
-            except Exception as e:
-                if future:
-                    future.set_exception(e)
-        except Exception as e:
-            logger.error(str(e))
+    # actions of the same client run in order, the others run concurrently
+    workers = int(await get_config_nwc("execution_workers") or 4)
+    await asyncio.gather(
+        *(execution_queue.run_worker() for _ in range(max(1, workers)))
+    )
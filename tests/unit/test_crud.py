@@ -0,0 +1,89 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+import pytest_asyncio
+
+from ... import crud, execution_queue
+from ...models import TrackedSpendNWC
+
+PUBKEY = "a" * 64
+
+
+@pytest_asyncio.fixture
+async def budget(monkeypatch):
+    """
+    A budget of 1000 msats, backed by an in-memory spent table
+    """
+    spent: list[dict] = []
+    now = int(time.time())
+
+    class FakeDatabase:
+        async def fetchone(self, query, values):
+            total = sum(
+                row["amount_msats"]
+                for row in spent
+                if row["pubkey"] == values["pubkey"]
+                and values["last_cycle"] <= row["created_at"] < values["next_cycle"]
+            )
+            return {"sum": total or None}
+
+        async def execute(self, query, values):
+            spent.append(dict(values))
+
+    async def fake_get_budgets_nwc(data):
+        return [
+            SimpleNamespace(
+                budget_msats=1000,
+                get_timestamp_range=lambda: (now - 3600, now + 3600),
+            )
+        ]
+
+    queue = execution_queue.ExecutionQueue()
+    monkeypatch.setattr(execution_queue, "execution_queue", queue)
+    monkeypatch.setattr(crud, "db", FakeDatabase())
+    monkeypatch.setattr(crud, "get_budgets_nwc", fake_get_budgets_nwc)
+    monkeypatch.setattr(crud, "spend_holds", {})
+    worker = asyncio.create_task(queue.run_worker())
+    yield spent
+    worker.cancel()
+
+
+def _spend(amount_msats):
+    return TrackedSpendNWC(pubkey=PUBKEY, amount_msats=amount_msats)
+
+
+@pytest.mark.asyncio
+async def test_holds_count_against_the_budget(budget):
+    first = await crud.reserve_spend_nwc(_spend(600))
+    assert first is not None
+    # the first payment is still in flight
+    assert await crud.reserve_spend_nwc(_spend(600)) is None
+    assert await crud.reserve_spend_nwc(_spend(400)) is not None
+
+
+@pytest.mark.asyncio
+async def test_failed_payment_releases_its_hold(budget):
+    async def failing_payment():
+        raise Exception("Payment failed")
+
+    with pytest.raises(Exception, match="Payment failed"):
+        await crud.tracked_spend_nwc(_spend(600), failing_payment)
+    assert crud.spend_holds == {}
+    assert budget == []
+    assert (await crud.tracked_spend_nwc(_spend(1000), _payment))[0]
+
+
+async def _payment():
+    return "b" * 64
+
+
+@pytest.mark.asyncio
+async def test_committed_spend_is_counted_once(budget):
+    assert await crud.tracked_spend_nwc(_spend(600), _payment) == (True, "b" * 64)
+    assert [row["amount_msats"] for row in budget] == [600]
+    assert crud.spend_holds == {}
+    assert await crud.tracked_spend_nwc(_spend(500), _payment) == (False, None)
+    assert (await crud.tracked_spend_nwc(_spend(400), _payment))[0]
+    assert [row["amount_msats"] for row in budget] == [600, 400]
@@ -0,0 +1,82 @@
+import asyncio
+import time
+
+import pytest
+
+from ...execution_queue import ExecutionQueue, ExpiredActionError
+
+
+async def _enqueue(queue: ExecutionQueue, key: str, action, deadline=None):
+    future = asyncio.get_running_loop().create_future()
+    queue.put(key, {"action": action, "future": future, "deadline": deadline})
+    return await future
+
+
+@pytest.mark.asyncio
+async def test_execution_queue_orders_per_key_and_runs_keys_concurrently():
+    queue = ExecutionQueue()
+    workers = [asyncio.create_task(queue.run_worker()) for _ in range(2)]
+    log: list[str] = []
+    slow_started = asyncio.Event()
+    slow_release = asyncio.Event()
+
+    def _action(name, started=None, release=None):
+        async def action():
+            log.append(name + " start")
+            if started:
+                started.set()
+            if release:
+                await release.wait()
+            log.append(name + " end")
+            return name
+
+        return action
+
+    try:
+        slow = asyncio.create_task(
+            _enqueue(queue, "a", _action("a1", slow_started, slow_release))
+        )
+        a2 = asyncio.create_task(_enqueue(queue, "a", _action("a2")))
+        await slow_started.wait()
+        # a slow action does not block the other keys
+        assert await asyncio.wait_for(_enqueue(queue, "b", _action("b1")), 1) == "b1"
+        assert "a2 start" not in log
+        slow_release.set()
+        assert await slow == "a1"
+        assert await a2 == "a2"
+        # actions of the same key run in order
+        assert log.index("a1 end") < log.index("a2 start")
+        assert queue.get_pending_count() == 0
+        assert not queue.queue.queues
+
+        with pytest.raises(ExpiredActionError):
+            await _enqueue(queue, "a", _action("a3"), deadline=time.time() - 1)
+        assert "a3 start" not in log
+    finally:
+        for worker in workers:
+            worker.cancel()
+
+
+@pytest.mark.asyncio
+async def test_execution_queue_keys_take_turns():
+    queue = ExecutionQueue()
+    log: list[str] = []
+
+    def _action(name):
+        async def action():
+            log.append(name)
+
+        return action
+
+    futures = [
+        asyncio.ensure_future(_enqueue(queue, key, _action(key + str(i))))
+        for key in ("a", "b")
+        for i in range(3)
+    ]
+    await asyncio.sleep(0)
+    worker = asyncio.create_task(queue.run_worker())
+    try:
+        await asyncio.gather(*futures)
+    finally:
+        worker.cancel()
+    assert log == ["a0", "b0", "a1", "b1", "a2", "b2"]
@@ -0,0 +1,48 @@
+import coincurve
+import pytest
+
+from ... import nip44
+
+SEC1 = bytes.fromhex("00" * 31 + "01")
+SEC2 = bytes.fromhex("00" * 31 + "02")
+
+
+def _pubkey(sec: bytes) -> str:
+    return coincurve.PrivateKey(sec).public_key_xonly.format().hex()
+
+
+def test_conversation_key():
+    conversation_key = nip44.get_conversation_key(SEC1, _pubkey(SEC2))
+    assert (
+        conversation_key.hex()
+        == "c41c775356fd92eadc63ff5a0dc1da211b268cbea22316767095b2871ea1412d"
+    )
+    assert conversation_key == nip44.get_conversation_key(SEC2, _pubkey(SEC1))
+
+
+def test_encrypt_decrypt_vector():
+    conversation_key = nip44.get_conversation_key(SEC1, _pubkey(SEC2))
+    nonce = bytes.fromhex("00" * 31 + "01")
+    payload = nip44.encrypt(conversation_key, "a", nonce)
+    assert payload == (
+        "AgAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAB"
+        "ee0G5VSK0/9YypIObAtDKfYEAjD35uVkHyB0F4DwrcNaCXlCWZKaArsGrY6M9wnuTMxW"
+        "fp1RTN9Xga8no+kF5Vsb"
+    )
+    assert nip44.decrypt(conversation_key, payload) == "a"
+
+
+@pytest.mark.parametrize(
+    "unpadded_len,padded_len",
+    [(16, 32), (32, 32), (33, 64), (65, 96), (320, 320), (515, 640), (1020, 1024)],
+)
+def test_padded_len(unpadded_len, padded_len):
+    assert nip44.calc_padded_len(unpadded_len) == padded_len
+
+
+def test_tampered_payload():
+    conversation_key = nip44.get_conversation_key(SEC1, _pubkey(SEC2))
+    payload = nip44.encrypt(conversation_key, "Hello World")
+    tampered = payload[:-8] + ("A" if payload[-8] != "A" else "B") + payload[-7:]
+    with pytest.raises(ValueError):
+        nip44.decrypt(conversation_key, tampered)
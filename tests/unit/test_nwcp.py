@@ -2,11 +2,25 @@ import asyncio
 import json
 import random
 import string
+import time
+from types import SimpleNamespace
 
 import pytest
 from loguru import logger
 
-from ...nwcp import NWCServiceProvider
+from ...nwcp import (
+    JSONCodec,
+    MainSubscription,
+    NWCServiceProvider,
+    PendingPublish,
+    ReconnectPolicy,
+    RelayHealth,
+    RequestDispatcher,
+    RequestStore,
+    Subscription,
+    get_request_deadline,
+    split_relays,
+)
 
 
 @pytest.fixture
@@ -32,6 +46,21 @@ def test_supported_methods(nwc_service_provider):
     assert s == ["make_invoice"]
 
 
+@pytest.mark.parametrize(
+    "data",
+    [
+        [0, "ab" * 32, 1700000000, 23194, [["p", "x"], ["e", "y"]], 'hé\n\t"\\😀'],
+        {"result_type": "get_balance", "result": {"balance": 1000, "x": None}},
+        [1.5, 1e16, 0.1, 2**64 + 1, -(2**63) - 1, -(2**70) - 1, "\x00\x1f\x7f"],
+    ],
+)
+def test_json_codec_matches_stdlib(data):
+    expected = json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+    for codec in (JSONCodec(use_orjson=False), JSONCodec()):
+        assert codec.dumps(data) == expected
+        assert codec.loads(expected) == data
+
+
 def test_encrytdecrypt(nwc_service_provider, nwc_service_provider2):
     content = "Hello World"
     enc_a = nwc_service_provider.private_key.encrypt_message(
@@ -52,6 +81,27 @@ def test_encrytdecrypt(nwc_service_provider, nwc_service_provider2):
     assert dec_b == content
 
 
+def test_cached_encryption(nwc_service_provider, nwc_service_provider2):
+    content = "Hello World"
+    pubkey2 = nwc_service_provider2.public_key_hex
+    enc = nwc_service_provider._encrypt(content, pubkey2)
+    dec = nwc_service_provider2.private_key.decrypt_message(
+        enc, nwc_service_provider.public_key_hex
+    )
+    assert dec == content
+
+    enc = nwc_service_provider2.private_key.encrypt_message(
+        content, nwc_service_provider.public_key_hex
+    )
+    assert nwc_service_provider._decrypt(enc, pubkey2) == content
+    # the shared secret was computed only once
+    assert nwc_service_provider.shared_secrets.misses == 1
+    assert nwc_service_provider.shared_secrets.hits == 1
+
+    nwc_service_provider.forget_client(pubkey2)
+    assert nwc_service_provider.shared_secrets.get(pubkey2) is None
+
+
 def test_signverify(nwc_service_provider, nwc_service_provider2):
     # Random content
     content = ""
@@ -75,6 +125,21 @@ def test_signverify(nwc_service_provider, nwc_service_provider2):
     assert nwc_service_provider2._verify_event(signed)
 
 
+def test_verify_cache(nwc_service_provider, nwc_service_provider2):
+    event = {"kind": 1, "content": "hello", "tags": [], "created_at": 1234567890}
+    signed = nwc_service_provider._sign_event(event)
+    cache = nwc_service_provider2.verified_events
+    assert nwc_service_provider2._verify_event(signed)
+    assert cache.misses == 1
+    # the same event received again is not verified again
+    assert nwc_service_provider2._verify_event(dict(signed))
+    assert cache.hits == 1
+    # a tampered copy with the same id is not trusted
+    tampered = dict(signed)
+    tampered["content"] = "bye"
+    assert not nwc_service_provider2._verify_event(tampered)
+
+
 @pytest.mark.asyncio
 async def test_handle(nwc_service_provider, nwc_service_provider2):
     content = nwc_service_provider._json_dumps(
@@ -97,7 +162,7 @@ async def test_handle(nwc_service_provider, nwc_service_provider2):
         assert content["params"]["invoice"] == "abc"
         return [({"preimage": "00000"}, None, [["r1", "v1"]])]
 
-    async def _send_pass(obj):
+    async def _send_pass(obj, relays=None):
         pass
 
     nwc_service_provider2._send = _send_pass
@@ -128,6 +193,40 @@ async def test_handle(nwc_service_provider, nwc_service_provider2):
         assert p_tag[0][1] == nwc_service_provider.public_key_hex
 
 
+@pytest.mark.asyncio
+async def test_handle_nip44(nwc_service_provider, nwc_service_provider2):
+    content = nwc_service_provider._json_dumps({"method": "get_balance"})
+    content = nwc_service_provider._encrypt(
+        content, nwc_service_provider2.public_key_hex, "nip44_v2"
+    )
+    event = {
+        "kind": 23194,
+        "content": content,
+        "tags": [
+            ["p", nwc_service_provider2.public_key_hex],
+            ["encryption", "nip44_v2"],
+        ],
+        "created_at": 1234567890,
+    }
+    signed = nwc_service_provider._sign_event(event)
+
+    async def _handle_get_balance(provider, pubkey, content):
+        return [({"balance": 1000}, None, [])]
+
+    async def _send_pass(obj, relays=None):
+        pass
+
+    nwc_service_provider2._send = _send_pass
+    nwc_service_provider2.add_request_listener("get_balance", _handle_get_balance)
+    sent_events = await nwc_service_provider2._handle_request(signed)
+    assert len(sent_events) == 1
+    # the response uses the same encryption as the request
+    content = nwc_service_provider._decrypt(
+        sent_events[0]["content"], nwc_service_provider2.public_key_hex, "nip44_v2"
+    )
+    assert json.loads(content)["result"]["balance"] == 1000
+
+
 @pytest.mark.asyncio
 async def test_send_info_event(nwc_service_provider):
     """_send_info_event should publish a signed kind-13194 event."""
@@ -137,11 +236,11 @@ async def test_send_info_event(nwc_service_provider):
 
     sent: list[list] = []
 
-    async def _send_capture(obj):
+    async def _send_capture(obj, relays=None):
         sent.append(obj)
 
     nwc_service_provider._send = _send_capture
-    nwc_service_provider.connected = True
+    nwc_service_provider.relays[0].connected = True
 
     await nwc_service_provider._send_info_event()
 
@@ -151,6 +250,7 @@ async def test_send_info_event(nwc_service_provider):
     event = msg[1]
     assert event["kind"] == 13194
     assert "pay_invoice" in event["content"]
+    assert ["encryption", "nip44_v2 nip04"] in event["tags"]
     assert nwc_service_provider._verify_event(event)
 
 
@@ -159,11 +259,11 @@ async def test_info_event_loop_resends(nwc_service_provider):
     """_info_event_loop should resend the info event while connected."""
     sent: list[list] = []
 
-    async def _send_capture(obj):
+    async def _send_capture(obj, relays=None):
         sent.append(obj)
 
     nwc_service_provider._send = _send_capture
-    nwc_service_provider.connected = True
+    nwc_service_provider.relays[0].connected = True
 
     loop_task = asyncio.create_task(nwc_service_provider._info_event_loop())
     # Allow the loop to run through one sleep cycle (patched to near-zero).
@@ -189,11 +289,11 @@ async def test_info_event_loop_skips_when_disconnected(nwc_service_provider):
     """_info_event_loop should not send the info event while disconnected."""
     sent: list[list] = []
 
-    async def _send_capture(obj):
+    async def _send_capture(obj, relays=None):
         sent.append(obj)
 
     nwc_service_provider._send = _send_capture
-    nwc_service_provider.connected = False  # not connected
+    nwc_service_provider.relays[0].connected = False  # not connected
 
     loop_task = asyncio.create_task(nwc_service_provider._info_event_loop())
     await asyncio.sleep(0)
@@ -205,3 +305,735 @@ async def test_info_event_loop_skips_when_disconnected(nwc_service_provider):
 
     # Nothing should have been sent because connected=False.
     assert len(sent) == 0
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_orders_per_pubkey_and_runs_clients_concurrently():
+    """Requests of one client are serialized, other clients are not blocked."""
+    handled: list[str] = []
+    slow_started = asyncio.Event()
+    release_slow = asyncio.Event()
+
+    async def _handler(event):
+        if event["id"] == "slow":
+            slow_started.set()
+            await release_slow.wait()
+        handled.append(event["id"])
+
+    dispatcher = RequestDispatcher(_handler, max_concurrency=4)
+    dispatcher.start()
+    try:
+        dispatcher.dispatch({"id": "slow", "pubkey": "a"})
+        dispatcher.dispatch({"id": "a2", "pubkey": "a"})
+        await slow_started.wait()
+        dispatcher.dispatch({"id": "b1", "pubkey": "b"})
+        # duplicates are ignored while queued
+        assert not dispatcher.dispatch({"id": "a2", "pubkey": "a"})
+
+        for _ in range(10):
+            await asyncio.sleep(0)
+        # b1 was handled while the slow request of "a" was still running
+        assert handled == ["b1"]
+        assert dispatcher.get_pending_count() == 2
+
+        release_slow.set()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        assert handled == ["b1", "slow", "a2"]
+        assert dispatcher.get_pending_count() == 0
+    finally:
+        dispatcher.stop()
+
+
+def test_request_store_pending_and_gc():
+    now = int(time.time())
+    store = RequestStore()
+    # a response can be registered before the request is seen
+    store.mark_responded("answered_early")
+    store.add({"id": "answered_early", "pubkey": "a", "created_at": now - 100})
+    store.add({"id": "old", "pubkey": "a", "created_at": now - 100})
+    store.add({"id": "new", "pubkey": "a", "created_at": now})
+    assert [e["id"] for e in store.get_pending()] == ["old", "new"]
+
+    store.mark_responded("old")
+    assert [e["id"] for e in store.get_pending()] == ["new"]
+    # only the compact record is kept for the processed events
+    assert store.events["old"].responded
+    assert "old" not in store.payloads
+    # processed requests without a response are not pending anymore
+    store.add({"id": "failed", "pubkey": "a", "created_at": now})
+    store.mark_processed("failed")
+    assert [e["id"] for e in store.get_pending()] == ["new"]
+
+    assert store.gc(50) == 2
+    assert set(store.events) == {"new", "failed"}
+    # old events without a response are evicted
+    store.add({"id": "unanswered", "pubkey": "a", "created_at": now - 100})
+    assert store.gc(50) == 1
+    assert set(store.events) == {"new", "failed"}
+    assert store.evicted["expired"] == 1
+
+
+def test_request_store_caps():
+    now = int(time.time())
+    store = RequestStore(max_events=4, max_events_per_client=2)
+    for i in range(3):
+        store.add({"id": "spam" + str(i), "pubkey": "spammer", "created_at": now})
+    # the oldest events of the client are evicted first
+    assert set(store.events) == {"spam1", "spam2"}
+    assert store.evicted["client_cap"] == 1
+
+    store.add({"id": "a", "pubkey": "a", "created_at": now - 10})
+    store.add({"id": "b", "pubkey": "b", "created_at": now})
+    store.add({"id": "c", "pubkey": "c", "created_at": now})
+    # the oldest events are evicted when the store is full
+    assert "a" not in store.events
+    assert len(store.events) == 4
+    assert store.evicted["global_cap"] == 1
+
+
+@pytest.mark.asyncio
+async def test_validation_rejects_before_crypto(
+    nwc_service_provider, nwc_service_provider2
+):
+    """Junk events are rejected by the cheap stages without any crypto."""
+    sp = nwc_service_provider2
+    relay = sp.relays[0]
+    relay.sub = MainSubscription(Subscription("req", {}), Subscription("res", {}))
+    crypto_checks: list[dict] = []
+
+    def _check_event_crypto(event):
+        crypto_checks.append(event)
+        return None
+
+    sp._check_event_crypto = _check_event_crypto
+
+    def _request(tags):
+        event = {
+            "kind": 23194,
+            "content": "x",
+            "tags": tags,
+            "created_at": int(time.time()),
+        }
+        return nwc_service_provider._sign_event(event)
+
+    valid = _request([["p", sp.public_key_hex]])
+    expired = _request([["p", sp.public_key_hex], ["expiration", "1"]])
+    await sp._on_event_message(relay, ["EVENT", "req", {"kind": 23194}])
+    await sp._on_event_message(relay, ["EVENT", "res", valid])
+    await sp._on_event_message(relay, ["EVENT", "req", _request([["p", "0" * 64]])])
+    await sp._on_event_message(relay, ["EVENT", "req", expired])
+    assert sp.rejected_events == {
+        "structure": 1,
+        "routing": 1,
+        "author": 1,
+        "expired": 1,
+    }
+    assert crypto_checks == []
+
+    await sp._on_event_message(relay, ["EVENT", "req", valid])
+    assert crypto_checks == [valid]
+    assert valid["id"] in sp.requests.events
+
+    # requests from unknown clients are dropped before any crypto
+    sp.set_client_filter(lambda pubkey: pubkey != nwc_service_provider.public_key_hex)
+    unknown = _request([["p", sp.public_key_hex], ["n", "1"]])
+    await sp._on_event_message(relay, ["EVENT", "req", unknown])
+    assert sp.rejected_events["client"] == 1
+    assert crypto_checks == [valid]
+    assert unknown["id"] not in sp.requests.events
+
+
+@pytest.mark.asyncio
+async def test_writer_keeps_unsent_frames_across_reconnects(nwc_service_provider):
+    """Frames that could not be sent are sent again once reconnected."""
+    sp = nwc_service_provider
+    relay = sp.relays[0]
+    sent: list[str] = []
+
+    class _FakeWebSocket:
+        def __init__(self, fail: bool):
+            self.fail = fail
+
+        async def send(self, frame):
+            if self.fail:
+                raise Exception("connection lost")
+            sent.append(frame)
+
+    # handlers do not wait for the connection
+    await sp._send(["EVENT", {"n": 1}])
+    await sp._send(["EVENT", {"n": 2}])
+    assert sp.get_outbound_queue_size() == 2
+
+    relay.ws = _FakeWebSocket(fail=True)
+    relay.connected = True
+    writer = asyncio.create_task(sp._writer_loop(relay))
+    try:
+        for _ in range(10):
+            await asyncio.sleep(0)
+        assert sent == []
+        assert not relay.connected
+        assert sp.get_outbound_queue_size() == 2
+
+        relay.ws = _FakeWebSocket(fail=False)
+        relay.connected = True
+        for _ in range(100):
+            if len(sent) == 2:
+                break
+            await asyncio.sleep(0.05)
+        assert [json.loads(frame)[1]["n"] for frame in sent] == [1, 2]
+        assert sp.get_outbound_queue_size() == 0
+    finally:
+        writer.cancel()
+
+
+@pytest.mark.asyncio
+async def test_wait_for_connection_wakes_up_when_ready(nwc_service_provider):
+    sp = nwc_service_provider
+    relay = sp.relays[0]
+    assert not sp.connected
+    waiter = asyncio.create_task(sp._wait_for_connection(relay))
+    await asyncio.sleep(0)
+    assert not waiter.done()
+
+    relay.connected = True
+    # woken up by the readiness event, well before the shutdown check
+    await asyncio.wait_for(waiter, 0.5)
+
+    relay.connected = False
+    sp.shutdown = True
+    with pytest.raises(Exception, match="Connection is closing"):
+        await sp._wait_for_connection(relay)
+
+
+@pytest.mark.asyncio
+async def test_publish_ack_tracking(nwc_service_provider):
+    sp = nwc_service_provider
+    relay = sp.relays[0]
+    for event_id in ("ok", "dup", "limited", "invalid"):
+        await sp._publish({"id": event_id})
+        sp._on_frame_sent(relay, event_id)
+    assert set(relay.pending_publishes) == {"ok", "dup", "limited", "invalid"}
+
+    await sp._on_message(relay, json.dumps(["OK", "ok", True, ""]))
+    await sp._on_message(relay, json.dumps(["OK", "dup", False, "duplicate: seen"]))
+    await sp._on_message(relay, json.dumps(["OK", "limited", False, "rate-limited:"]))
+    await sp._on_message(relay, json.dumps(["OK", "invalid", False, "invalid: bad"]))
+    # accepted and duplicate events are done, rejected events are retried
+    # only if the failure is temporary
+    assert set(relay.pending_publishes) == {"limited"}
+    assert sp.publish_stats["acked"] == 2
+    assert sp.publish_stats["rejected"] == 2
+    assert sp.publish_stats["failed"] == 1
+    assert relay.pending_publishes["limited"].next_retry_at > time.monotonic()
+
+
+def test_publish_ack_timeout_backoff():
+    sp = NWCServiceProvider(
+        None, "wss://a", publish_ack_timeout=10, publish_max_attempts=4
+    )
+    relay = sp.relays[0]
+    relay.sends_ok = True
+    relay.pending_publishes["e"] = pending = PendingPublish('["EVENT"]')
+    timeouts = []
+    for _ in range(3):
+        sp._on_frame_sent(relay, "e")
+        timeouts.append(round(pending.next_retry_at - time.monotonic()))
+        # the acknowledgment does not arrive in time
+        pending.next_retry_at = 0
+        sp._retry_publishes(relay)
+        relay.outbox.get_nowait()
+    assert timeouts == [10, 20, 40]
+    assert pending.attempts == 4
+
+
+def test_reconnect_policy():
+    policy = ReconnectPolicy(base_delay=0.5, max_delay=10)
+    health = RelayHealth()
+    health.on_connected(0.1)
+    # a stable connection is re-established right away
+    health.connected_at -= 60
+    assert policy.next_delay(health, health.on_closed(10)) == 0
+
+    # a connection dropped right after connecting is not stable
+    health.on_connected(0.1)
+    assert not health.on_closed(10)
+    assert policy.next_delay(health, False) > 0
+
+    previous_score = health.score()
+    for _ in range(20):
+        health.on_failure()
+        delay = policy.next_delay(health, False)
+        assert policy.base_delay <= delay <= policy.max_delay
+    assert health.score() < previous_score
+    # the floor grows with the failures
+    assert policy.next_delay(health, False) == policy.max_delay
+    assert health.get_stats()["consecutive_failures"] == 21
+
+
+@pytest.mark.asyncio
+async def test_latency_is_taken_from_the_keepalive():
+    sp = NWCServiceProvider(
+        None, "wss://a", reconnect_policy=ReconnectPolicy(ping_interval=0.01)
+    )
+    relay = sp.relays[0]
+    ws = SimpleNamespace(latency=0)
+    task = asyncio.create_task(sp._latency_loop(relay, ws))
+    await asyncio.sleep(0.03)
+    # no pong received yet
+    assert relay.health.ping_rtt == 0
+    ws.latency = 0.2
+    await asyncio.sleep(0.03)
+    task.cancel()
+    assert relay.health.ping_rtt > 0
+
+
+def test_split_relays():
+    assert split_relays(None) == []
+    assert split_relays("wss://a, wss://b wss://a") == ["wss://a", "wss://b"]
+    assert split_relays(["wss://a", " wss://b "]) == ["wss://a", "wss://b"]
+
+
+@pytest.mark.asyncio
+async def test_multi_relay(nwc_service_provider, nwc_service_provider2):
+    sp = NWCServiceProvider(
+        nwc_service_provider2.private_key_hex, "wss://a, wss://b", max_outbound_queue=1
+    )
+    relay_a, relay_b = sp.relays
+    dispatched: list[str] = []
+    sp.dispatcher.dispatch = lambda event: dispatched.append(event["id"])
+    for relay in sp.relays:
+        relay.sub = MainSubscription(Subscription("req", {}), Subscription("res", {}))
+        relay.sub.requests.eose = relay.sub.responses.eose = True
+
+    event = {
+        "kind": 23194,
+        "content": "x",
+        "tags": [["p", sp.public_key_hex]],
+        "created_at": int(time.time()),
+    }
+    nwc_service_provider._sign_event(event)
+    # the same request is received from both relays, but handled once
+    await sp._on_event_message(relay_a, ["EVENT", "req", event])
+    sp.requests.mark_processed(event["id"])
+    await sp._on_event_message(relay_b, ["EVENT", "req", dict(event)])
+    assert dispatched == [event["id"]]
+
+    # events are published to all the relays
+    await sp._publish({"id": "1"})
+    assert relay_a.get_outbound_queue_size() == 1
+    assert relay_b.get_outbound_queue_size() == 1
+    assert "1" in relay_a.pending_publishes and "1" in relay_b.pending_publishes
+
+    # a relay that is down and full does not block the others
+    relay_a.connected = True
+    task = asyncio.create_task(sp._publish({"id": "2"}))
+    await asyncio.sleep(0)
+    assert relay_b.dropped == 1
+    assert "2" not in relay_b.pending_publishes
+    relay_a.outbox.get_nowait()
+    await asyncio.wait_for(task, 0.5)
+    assert relay_a.outbox.get_nowait()[1] == "2"
+
+
+@pytest.mark.asyncio
+async def test_catchup_waits_for_the_responses_of_all_relays(
+    nwc_service_provider, nwc_service_provider2
+):
+    sp = NWCServiceProvider(nwc_service_provider2.private_key_hex, "wss://a, wss://b")
+    relay_a, relay_b = sp.relays
+    dispatched: list[dict] = []
+    sp.dispatcher.dispatch = dispatched.append
+    for relay in sp.relays:
+        relay.sub = MainSubscription(Subscription("req", {}), Subscription("res", {}))
+        relay.connected = True
+
+    def _event(kind, tags):
+        event = {
+            "kind": kind,
+            "content": "x",
+            "tags": tags,
+            "created_at": int(time.time()) - 10,
+        }
+        return nwc_service_provider._sign_event(event)
+
+    answered = _event(23194, [["p", sp.public_key_hex]])
+    stale = _event(23194, [["p", sp.public_key_hex], ["n", "2"]])
+    await sp._on_message(relay_a, json.dumps(["EVENT", "req", answered]))
+    await sp._on_message(relay_a, json.dumps(["EVENT", "req", stale]))
+    await sp._on_message(relay_a, json.dumps(["EOSE", "req"]))
+    await sp._on_message(relay_a, json.dumps(["EOSE", "res"]))
+    # relay b is still sending the stored responses
+    assert dispatched == []
+    response = nwc_service_provider2._sign_event(
+        {
+            "kind": 23195,
+            "content": "x",
+            "tags": [["e", answered["id"]], ["p", nwc_service_provider.public_key_hex]],
+            "created_at": int(time.time()) - 5,
+        }
+    )
+    await sp._on_message(relay_b, json.dumps(["EVENT", "res", response]))
+    await sp._on_message(relay_b, json.dumps(["EOSE", "res"]))
+    assert [event["id"] for event in dispatched] == [stale["id"]]
+
+    # a response received while the request is queued stops it
+    handled: list[str] = []
+
+    async def _handle_request(event):
+        handled.append(event["id"])
+        return []
+
+    sp._handle_request = _handle_request
+    sp.requests.mark_responded(stale["id"])
+    await sp._process_request(stale)
+    assert handled == []
+
+
+@pytest.mark.asyncio
+async def test_closed_subscription_is_resumed(
+    nwc_service_provider, nwc_service_provider2
+):
+    sp = nwc_service_provider2
+    relay = sp.relays[0]
+    sent: list[list] = []
+
+    class _FakeWebSocket:
+        async def send(self, frame):
+            sent.append(json.loads(frame))
+
+    relay.ws = _FakeWebSocket()
+    sp.handle_missed_events = 60
+    await sp._subscribe(relay)
+    sub = relay.sub
+    assert [frame[1] for frame in sent] == [
+        sub.requests.sub_id,
+        sub.responses.sub_id,
+    ]
+    sent.clear()
+
+    event = {
+        "kind": 23194,
+        "content": "x",
+        "tags": [["p", sp.public_key_hex]],
+        "created_at": int(time.time()) - 10,
+    }
+    nwc_service_provider._sign_event(event)
+    await sp._on_message(relay, json.dumps(["EVENT", sub.requests.sub_id, event]))
+    await sp._on_message(relay, json.dumps(["EOSE", sub.responses.sub_id]))
+
+    await sp._on_message(relay, json.dumps(["CLOSED", sub.requests.sub_id, "x"]))
+    # only the closed subscription is resumed, the stored events
+    # were not all received yet
+    assert sent == [["REQ", sub.requests.sub_id, sub.requests.filters]]
+    assert relay.sub is sub
+    assert sub.responses.eose
+    assert sub.catchup_ids == [event["id"]]
+    assert sp.requests.is_pending(event["id"])
+
+    # after the eose, it is resumed from the last seen event
+    sp.dispatcher.dispatch = lambda event: True
+    await sp._on_message(relay, json.dumps(["EOSE", sub.requests.sub_id]))
+    live = {**event, "created_at": int(time.time()) - 5}
+    del live["id"]
+    nwc_service_provider._sign_event(live)
+    await sp._on_message(relay, json.dumps(["EVENT", sub.requests.sub_id, live]))
+    sent.clear()
+    await sp._on_message(relay, json.dumps(["CLOSED", sub.requests.sub_id, "x"]))
+    assert sent == [
+        [
+            "REQ",
+            sub.requests.sub_id,
+            {**sub.requests.filters, "since": live["created_at"]},
+        ]
+    ]
+
+
+def _set_caught_up(sp):
+    for relay in sp.relays:
+        relay.sub = MainSubscription(Subscription("requests", {}))
+        relay.sub.requests.eose = True
+
+
+@pytest.mark.asyncio
+async def test_checkpoints(nwc_service_provider):
+    now = int(time.time())
+    sp = NWCServiceProvider(
+        nwc_service_provider.private_key_hex,
+        "wss://a",
+        handle_missed_events=3600,
+        checkpoints={"requests": now - 100, "responses": now - 50},
+        checkpoint_skew=10,
+    )
+    # resume from the checkpoint, not from the whole window
+    assert sp._get_since(sp.checkpoints["requests"]) == now - 110
+    assert sp._get_since(now - 7200) == now - 3600
+    assert sp._get_since(0) == now - 3600
+
+    saved: list[dict] = []
+
+    async def _save(checkpoints):
+        saved.append(checkpoints)
+
+    sp.set_checkpoint_listener(_save)
+    _set_caught_up(sp)
+    await sp._save_checkpoints()
+    assert saved == []
+
+    def _request(event_id, created_at):
+        return {"id": event_id, "pubkey": "p", "created_at": created_at}
+
+    sp.requests.add(_request("a", now - 40))
+    sp.requests.add(_request("b", now - 30))
+    sp.requests.add(_request("c", now - 20))
+    sp.requests.mark_processed("a")
+    sp.requests.mark_processed("c")
+    # b is still waiting to be processed
+    await sp._save_checkpoints()
+    assert saved == [{"requests": now - 30, "responses": now - 50}]
+    sp.requests.mark_responded("b")
+    await sp._save_checkpoints()
+    assert saved[-1] == {"requests": now - 20, "responses": now - 50}
+    await sp._save_checkpoints()
+    assert len(saved) == 2
+
+
+@pytest.mark.asyncio
+async def test_checkpoints_ignore_future_requests(nwc_service_provider):
+    now = int(time.time())
+    sp = NWCServiceProvider(
+        nwc_service_provider.private_key_hex, "wss://a", handle_missed_events=3600
+    )
+    saved: list[dict] = []
+
+    async def _save(checkpoints):
+        saved.append(checkpoints)
+
+    sp.set_checkpoint_listener(_save)
+    _set_caught_up(sp)
+
+    def _request(event_id, created_at):
+        return {"id": event_id, "pubkey": "p", "created_at": created_at}
+
+    # a request dated in the future, still waiting to be processed
+    sp.requests.add(_request("a", now + 86400))
+    assert sp.requests.get_checkpoint() <= int(time.time())
+    sp.requests.mark_processed("a")
+    sp.requests.add(_request("b", 2**32))
+    sp.requests.mark_responded("b")
+    await sp._save_checkpoints()
+    assert now <= saved[-1]["requests"] <= int(time.time())
+    # the live requests are still fetched
+    assert sp._get_since(sp.checkpoints["requests"]) <= int(time.time())
+
+
+@pytest.mark.asyncio
+async def test_checkpoints_wait_for_eose(nwc_service_provider):
+    client = nwc_service_provider
+    now = int(time.time())
+    sp = NWCServiceProvider(None, "wss://a", handle_missed_events=3600)
+    saved: list[dict] = []
+
+    async def _save(checkpoints):
+        saved.append(checkpoints)
+
+    sp.set_checkpoint_listener(_save)
+    sp.dispatcher.dispatch = lambda event: True
+    relay = sp.relays[0]
+    sent: list[list] = []
+
+    class _FakeWebSocket:
+        async def send(self, frame):
+            sent.append(json.loads(frame))
+
+    def _event(kind, created_at, tags):
+        event = {
+            "kind": kind,
+            "content": "x",
+            "tags": tags,
+            "created_at": created_at,
+        }
+        return client._sign_event(event)
+
+    relay.ws = _FakeWebSocket()
+    await sp._subscribe(relay)
+    sub = relay.sub
+    # the stored events are received newest first
+    request = _event(23194, now - 10, [["p", sp.public_key_hex]])
+    await sp._on_message(relay, json.dumps(["EVENT", sub.requests.sub_id, request]))
+    sp._on_response({"created_at": now - 5})
+    await sp._save_checkpoints()
+    assert saved == []
+    # the connection drops before the eose, the older events are fetched again
+    sent.clear()
+    await sp._subscribe(relay)
+    assert [frame[2]["since"] for frame in sent] == [now - 3600, now - 3600]
+
+    sub = relay.sub
+    await sp._on_message(relay, json.dumps(["EVENT", sub.requests.sub_id, request]))
+    for s in sub.get_all():
+        await sp._on_message(relay, json.dumps(["EOSE", s.sub_id]))
+    await sp._save_checkpoints()
+    assert saved == [{"requests": now - 10, "responses": now - 5}]
+
+
+@pytest.mark.asyncio
+async def test_handled_requests_journal(nwc_service_provider):
+    client = nwc_service_provider
+
+    def _request(n):
+        event = {
+            "kind": 23194,
+            "content": "x",
+            "tags": [["p", sp.public_key_hex], ["n", str(n)]],
+            "created_at": int(time.time()) - 10,
+        }
+        return client._sign_event(event)
+
+    sp = NWCServiceProvider(None, "wss://a", subscribe_responses=False)
+    handled = _request(1)
+    # requests handled before the restart are not handled again
+    sp = NWCServiceProvider(
+        sp.private_key_hex,
+        "wss://a",
+        handled_requests=[handled["id"]],
+        subscribe_responses=False,
+    )
+    journal: list[str] = []
+
+    async def _append(event_id, created_at):
+        journal.append(event_id)
+
+    sp.set_journal(_append)
+    relay = sp.relays[0]
+    sent: list[list] = []
+
+    class _FakeWebSocket:
+        async def send(self, frame):
+            sent.append(json.loads(frame))
+
+    relay.ws = _FakeWebSocket()
+    await sp._subscribe(relay)
+    # only the requests are fetched from the relay
+    assert [frame[2]["kinds"] for frame in sent] == [[23194]]
+    sub_id = relay.sub.requests.sub_id
+
+    dispatched: list[dict] = []
+    sp.dispatcher.dispatch = dispatched.append
+    pending = _request(2)
+    await sp._on_message(relay, json.dumps(["EVENT", sub_id, handled]))
+    await sp._on_message(relay, json.dumps(["EVENT", sub_id, pending]))
+    await sp._on_message(relay, json.dumps(["EOSE", sub_id]))
+    assert [event["id"] for event in dispatched] == [pending["id"]]
+
+    async def _handle_request(event):
+        return []
+
+    sp._handle_request = _handle_request
+    await sp._process_request(pending)
+    assert journal == [pending["id"]]
+
+    # requests that cannot be journaled are not handled
+    handled: list[str] = []
+
+    async def _failing_append(event_id, created_at):
+        raise Exception("database is locked")
+
+    async def _handle_request_capture(event):
+        handled.append(event["id"])
+        return []
+
+    sp.set_journal(_failing_append)
+    sp._handle_request = _handle_request_capture
+    failing = _request(3)
+    sp.requests.add(failing)
+    await sp._process_request(failing)
+    assert handled == []
+
+
+@pytest.mark.asyncio
+async def test_expiration_tags(nwc_service_provider, nwc_service_provider2):
+    sent: list[list] = []
+
+    async def _send_capture(obj, relays=None):
+        sent.append(obj)
+
+    content = nwc_service_provider._json_dumps({"method": "get_balance"})
+    content = nwc_service_provider.private_key.encrypt_message(
+        content, nwc_service_provider2.public_key_hex
+    )
+    event = {
+        "kind": 23194,
+        "content": content,
+        "tags": [["p", nwc_service_provider2.public_key_hex]],
+        "created_at": int(time.time()),
+    }
+    signed = nwc_service_provider._sign_event(event)
+
+    async def _handle_get_balance(provider, pubkey, content):
+        return [({"balance": 1000}, None, [])]
+
+    sp = NWCServiceProvider(
+        nwc_service_provider2.private_key_hex, "wss://a", handle_missed_events=3600
+    )
+    sp._send = _send_capture
+    sp.add_request_listener("get_balance", _handle_get_balance)
+    # the responses expire with the catch-up window by default
+    [res] = await sp._handle_request(signed)
+    assert ["expiration", str(res["created_at"] + 3600)] in res["tags"]
+    assert sp._verify_event(res)
+    # the info event does not expire by default
+    await sp._send_info_event()
+    assert not any(tag[0] == "expiration" for tag in sent[-1][1]["tags"])
+
+    sp = NWCServiceProvider(
+        nwc_service_provider2.private_key_hex,
+        "wss://a",
+        response_ttl=0,
+        info_event_ttl=300,
+    )
+    sp._send = _send_capture
+    sp.add_request_listener("get_balance", _handle_get_balance)
+    [res] = await sp._handle_request(signed)
+    assert not any(tag[0] == "expiration" for tag in res["tags"])
+    await sp._send_info_event()
+    info = sent[-1][1]
+    assert ["expiration", str(info["created_at"] + 300)] in info["tags"]
+    assert sp._verify_event(info)
+
+
+@pytest.mark.asyncio
+async def test_expired_requests_are_dropped(nwc_service_provider):
+    client = nwc_service_provider
+    sp = NWCServiceProvider(None, "wss://a", max_request_age=60)
+    deadlines: list = []
+
+    async def _handle_request(event):
+        deadlines.append(get_request_deadline())
+        return []
+
+    sp._handle_request = _handle_request
+
+    def _request(created_at, tags):
+        event = {
+            "kind": 23194,
+            "content": "x",
+            "tags": [["p", sp.public_key_hex], *tags],
+            "created_at": created_at,
+        }
+        client._sign_event(event)
+        sp.requests.add(event)
+        return event
+
+    now = int(time.time())
+    # too old
+    await sp._process_request(_request(now - 120, []))
+    # expired while queued
+    await sp._process_request(_request(now, [["expiration", str(now - 1)]]))
+    assert deadlines == []
+    assert sp.get_stats()["expired_requests"] == 2
+    # the deadline is the earliest of the expiration and the max age
+    await sp._process_request(_request(now, [["expiration", str(now + 30)]]))
+    await sp._process_request(_request(now, []))
+    assert deadlines == [now + 30, now + 60]
+    assert get_request_deadline() is None
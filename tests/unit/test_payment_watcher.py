@@ -0,0 +1,67 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from ...payment_watcher import PaymentWatcher
+
+
+@pytest.mark.asyncio
+async def test_payment_watcher():
+    checks: list[str] = []
+    settled: dict[str, SimpleNamespace] = {}
+
+    async def _check_status(wallet_id, payment_hash):
+        checks.append(payment_hash)
+        return settled.get(payment_hash, SimpleNamespace(success=False, failed=False))
+
+    watcher = PaymentWatcher(_check_status, min_interval=0.01, max_interval=0.04)
+    a = asyncio.create_task(watcher.wait("w", "a", 1))
+    a2 = asyncio.create_task(watcher.wait("w", "a", 1))
+    b = asyncio.create_task(watcher.wait("w", "b", 1))
+    await asyncio.sleep(0.05)
+    # a single poller checks all the pending payments
+    assert "a" in checks and "b" in checks
+    assert watcher.get_stats()["in_flight"] == 2
+    assert watcher.get_stats()["waiters"] == 3
+    settled["a"] = SimpleNamespace(success=True, failed=False)
+    settled["b"] = SimpleNamespace(success=False, failed=True)
+    # every waiter of a payment is resolved
+    assert (await a).success
+    assert (await a2).success
+    assert (await b).failed
+    stats = watcher.get_stats()
+    assert stats["in_flight"] == 0
+    assert stats["settled"] == 2
+    assert stats["settle_latency_max_ms"] >= stats["settle_latency_avg_ms"] > 0
+
+    # the payments are checked less often while they are pending
+    checks.clear()
+    with pytest.raises(asyncio.TimeoutError):
+        await watcher.wait("w", "c", 0.2)
+    assert 3 < len(checks) < 10
+    assert watcher.get_stats()["timed_out"] == 1
+    assert not watcher.payments
+    # the poller stops when there is nothing to watch
+    assert watcher.task
+    await asyncio.wait_for(watcher.task, 1)
+
+
+@pytest.mark.asyncio
+async def test_payment_watcher_batches():
+    running = 0
+    max_running = 0
+
+    async def _check_status(wallet_id, payment_hash):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return SimpleNamespace(success=True, failed=False)
+
+    watcher = PaymentWatcher(_check_status, min_interval=0.01, max_batch_size=3)
+    results = await asyncio.gather(*(watcher.wait("w", str(i), 1) for i in range(10)))
+    assert all(status.success for status in results)
+    assert max_running == 3
+    assert watcher.get_stats()["checks"] == 10
@@ -1,3 +1,4 @@
+import asyncio
 from types import SimpleNamespace
 
 import pytest
@@ -29,3 +30,55 @@ async def test_process_invoice_returns_payment_failed_on_failed_status(monkeypat
     assert result["error"]["code"] == "PAYMENT_FAILED"
     assert result["error"]["message"] == "Payment failed."
     assert result["in_budget"] is True
+
+
+@pytest.mark.asyncio
+async def test_process_invoice_does_not_pay_expired_requests(monkeypatch):
+    async def fake_tracked_spend_nwc(*args, **kwargs):
+        raise tasks.ExpiredActionError("Action expired while queued")
+
+    monkeypatch.setattr(tasks, "tracked_spend_nwc", fake_tracked_spend_nwc)
+
+    result = await tasks._process_invoice(
+        wallet_id="wallet123",
+        pubkey="a" * 64,
+        invoice="lnbc1example",
+        amount_msats=1000,
+        description="test",
+    )
+
+    assert result["error"]["code"] == "OTHER"
+    assert result["in_budget"] is False
+
+
+@pytest.mark.asyncio
+async def test_multi_pay_invoice_pays_concurrently_and_keeps_order(monkeypatch):
+    running = 0
+    max_running = 0
+
+    async def fake_get_nwc(data):
+        return SimpleNamespace(wallet="wallet123")
+
+    async def fake_check(nwc, method):
+        return None
+
+    async def fake_pay_multi_invoice(wallet_id, pubkey, i):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return ({"preimage": "00"}, None, [["d", i["id"]]])
+
+    monkeypatch.setattr(tasks, "get_nwc", fake_get_nwc)
+    monkeypatch.setattr(tasks, "_check", fake_check)
+    monkeypatch.setattr(tasks, "_pay_multi_invoice", fake_pay_multi_invoice)
+    monkeypatch.setattr(tasks, "multi_pay_concurrency", 3)
+
+    invoices = [{"id": str(n), "invoice": "lnbc1example"} for n in range(10)]
+    results = await tasks._on_multi_pay_invoice(
+        None, "a" * 64, {"params": {"invoices": invoices}}
+    )
+
+    assert [tags for _, _, tags in results] == [[["d", str(n)]] for n in range(10)]
+    assert max_running == 3
@@ -25,6 +25,7 @@ from .models import (
     NWCGetResponse,
     NWCRegistrationRequest,
 )
+from .nwcp import split_relays
 from .paranoia import (
     assert_boolean,
     assert_sane_string,
@@ -32,6 +33,7 @@ from .paranoia import (
     assert_valid_wallet_id,
 )
 from .permission import nwc_permissions
+from .tasks import get_nwc_stats
 
 nwcprovider_api_router = APIRouter()
 
@@ -114,17 +116,20 @@ async def api_get_pairing_url(req: Request, secret: str) -> str:
         raise Exception("Extension is not configured")
     relay_alias: str | None = await get_config_nwc("relay_alias")
     if relay_alias:
-        relay = relay_alias
+        relays = split_relays(relay_alias)
     else:
-        if relay == "nostrclient":
-            scheme = req.url.scheme  # http or https
-            netloc = req.url.netloc  # hostname and port
-            if scheme == "http":
-                scheme = "ws"
-            else:
-                scheme = "wss"
-            netloc += "/nostrclient/api/v1/relay"
-            relay = f"{scheme}://{netloc}"
+        relays = []
+        for relay_url in split_relays(relay):
+            if relay_url == "nostrclient":
+                scheme = req.url.scheme  # http or https
+                netloc = req.url.netloc  # hostname and port
+                if scheme == "http":
+                    scheme = "ws"
+                else:
+                    scheme = "wss"
+                netloc += "/nostrclient/api/v1/relay"
+                relay_url = f"{scheme}://{netloc}"
+            relays.append(relay_url)
     psk = PrivateKey.from_hex(pprivkey)
     ppk = psk.public_key
     if not ppk:
@@ -132,7 +137,8 @@ async def api_get_pairing_url(req: Request, secret: str) -> str:
     ppubkey = ppk.hex()
     url = "nostr+walletconnect://"
     url += ppubkey
-    url += "?relay=" + relay
+    # one relay parameter for each relay
+    url += "?relay=" + "&relay=".join(relays)
     url += "&secret=" + secret
     # lud16=?
     return url
@@ -219,3 +225,9 @@ async def api_set_config_nwc(req: Request):
     for key, value in data.items():
         await set_config_nwc(key, value)
     return await api_get_all_config_nwc()
+
+
+# Get service provider stats
+@nwcprovider_api_router.get("/api/v1/stats", dependencies=[Depends(check_admin)])
+async def api_get_stats_nwc() -> dict:
+    return get_nwc_stats()